@@ -1,11 +1,24 @@
-from gtts import gTTS
-import io
+import logging
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 import streamlit as st
+from config import get_setting
+from singleflight import get_singleflight, make_flight_key
+from tts_backends import get_tts_backend
+from utils import chunk_text, split_sentences
+
+TTS_MAX_WORKERS = 4
+
+# Shared across calls so the total number of concurrent gTTS requests stays bounded
+_tts_executor = None
+_tts_executor_lock = threading.Lock()
 
-@st.cache_data(show_spinner=False)
 def text_to_speech(text, lang='en', slow=False):
     """
-    Convert text to speech using Google Text-to-Speech API.
+    Convert text to speech with the configured TTS backend (Google Text-to-Speech by default).
+    Results are cached by the backend's (text hash, lang, slow) cache.
     
     Args:
     text (str): The text to convert to speech.
@@ -16,21 +29,15 @@ def text_to_speech(text, lang='en', slow=False):
     bytes: The audio data as bytes.
     """
     try:
-        tts = gTTS(text=text, lang=lang, slow=slow)
-        
-        # Use an in-memory bytes buffer instead of a temporary file
-        audio_buffer = io.BytesIO()
-        tts.write_to_fp(audio_buffer)
-        audio_bytes = audio_buffer.getvalue()
-        
-        return audio_bytes
+        # Concurrent identical requests share one synthesis
+        return get_singleflight("tts").do(make_flight_key(text, lang, slow), get_tts_backend().synthesize, text, lang, slow)
     except Exception as e:
         st.error(f"Failed to generate audio: {str(e)}")
         return None
 
 def split_text(text, max_length=5000):
     """
-    Split long text into smaller chunks that fit within gTTS character limit.
+    Split long text into sentence-aligned chunks that fit within the TTS engine's character limit.
     
     Args:
     text (str): The text to split.
@@ -39,74 +46,169 @@ def split_text(text, max_length=5000):
     Returns:
     list: A list of text chunks.
     """
-    words = text.split()
+    return chunk_text(text, min(max_length, get_tts_backend().max_chars))
+
+def stream_story_audio(story_text, lang='en', slow=False, timings=None):
+    """
+    Synthesize a story sentence by sentence, yielding each sentence's audio as soon
+    as it and every sentence before it are ready.
+    
+    All sentences are queued on the shared TTS pool at once, so later sentences are
+    synthesized while earlier ones are already playing. A sentence that fails is
+    retried once; if it fails again the stream raises RuntimeError rather than
+    leaving the sentence out.
+    
+    Args:
+    story_text (str): The complete story text.
+    lang (str): The language of Latin-script text; other scripts are detected per span.
+    slow (bool): Whether to speak slowly.
+    timings (dict): Optional dict that receives "first_audio" and "total" in seconds.
+    
+    Yields:
+    bytes: Playable audio for the next sentence.
+    """
+    start = time.perf_counter()
+    # One chunk per sentence and language span, unless a sentence is over the engine's limit
+    pieces = [
+        (span_lang, piece)
+        for span_lang, span in split_language_spans(story_text, lang)
+        for sentence in split_sentences(span)
+        for piece in split_text(sentence)
+    ]
+    futures = [_get_tts_executor().submit(text_to_speech, piece, span_lang, slow) for span_lang, piece in pieces]
+    try:
+        for (span_lang, piece), future in zip(pieces, futures):
+            audio_bytes = future.result()
+            if not audio_bytes and piece.strip():
+                # Retry once; a story with a sentence missing is worse than no audio
+                audio_bytes = text_to_speech(piece, span_lang, slow)
+                if not audio_bytes:
+                    raise RuntimeError(f"Could not synthesize audio for: {piece[:50]!r}")
+            if not audio_bytes:
+                continue
+            if timings is not None and "first_audio" not in timings:
+                timings["first_audio"] = time.perf_counter() - start
+            yield audio_bytes
+    finally:
+        for future in futures:
+            future.cancel()
+        if timings is not None:
+            timings["total"] = time.perf_counter() - start
+
+def synthesize_story_audio(story_text, lang='en', progress=None):
+    """
+    Synthesize a whole story through stream_story_audio, publishing each ready
+    chunk to `progress` so it can be played before synthesis finishes.
+    
+    Returns:
+    dict: "audio" (the complete audio bytes), "format" (its MIME type), "first_audio" and "total" seconds.
+    """
+    timings = {}
     chunks = []
-    current_chunk = []
+    for audio_bytes in stream_story_audio(story_text, lang, timings=timings):
+        chunks.append(audio_bytes)
+        if progress is not None:
+            progress.append(audio_bytes)
+    if not chunks:
+        return None
+    backend = get_tts_backend()
+    return {"audio": backend.join(chunks), "format": backend.mime_type, **timings}
 
-    for word in words:
-        if len(' '.join(current_chunk + [word])) <= max_length:
-            current_chunk.append(word)
-        else:
-            chunks.append(' '.join(current_chunk))
-            current_chunk = [word]
+def _get_tts_executor():
+    global _tts_executor
+    with _tts_executor_lock:
+        if _tts_executor is None:
+            _tts_executor = ThreadPoolExecutor(
+                max_workers=int(get_setting("TTS_MAX_WORKERS", TTS_MAX_WORKERS)),
+                thread_name_prefix="storify-tts",
+            )
+        return _tts_executor
 
-    if current_chunk:
-        chunks.append(' '.join(current_chunk))
+# Unicode ranges of the scripts we route to a TTS language. The table is compiled
+# into one regex, so the text is scanned once, in C, instead of once per language.
+SCRIPT_RANGES = {
+    "latin": [("A", "Z"), ("a", "z"), ("\u00c0", "\u024f")],
+    "cyrillic": [("\u0400", "\u052f")],
+    "arabic": [("\u0600", "\u06ff"), ("\u0750", "\u077f"), ("\ufb50", "\ufdff"), ("\ufe70", "\ufeff")],
+    "devanagari": [("\u0900", "\u097f")],
+    "kana": [("\u3040", "\u30ff"), ("\u31f0", "\u31ff"), ("\uff66", "\uff9f")],
+    "han": [("\u3400", "\u4dbf"), ("\u4e00", "\u9fff")],
+    "hangul": [("\u1100", "\u11ff"), ("\u3130", "\u318f"), ("\uac00", "\ud7a3")],
+}
+SCRIPT_LANGUAGES = {"cyrillic": "ru", "devanagari": "hi", "kana": "ja", "hangul": "ko"}
 
-    return chunks
+_SCRIPT_PATTERN = re.compile("|".join(
+    f"(?P<{script}>[{''.join(f'{re.escape(start)}-{re.escape(end)}' for start, end in ranges)}]+)"
+    for script, ranges in SCRIPT_RANGES.items()
+))
+_KANA_PATTERN = re.compile(f"[{''.join(f'{start}-{end}' for start, end in SCRIPT_RANGES['kana'])}]")
+# Letters used in Urdu but not in Arabic
+_URDU_PATTERN = re.compile("[\u0679\u0688\u0691\u06ba\u06be\u06c1\u06d2\u06d3]")
 
-@st.cache_data(show_spinner=False)
-def generate_audio_for_story(story_text, lang='en'):
+def _script_runs(text, default_lang):
+    """Yield (start, end, lang) for each run of letters in one script."""
+    has_kana = None
+    is_urdu = None
+    for match in _SCRIPT_PATTERN.finditer(text):
+        script = match.lastgroup
+        if script == "latin":
+            lang = default_lang
+        elif script == "han":
+            # Kanji are Japanese when the text also contains kana, otherwise Chinese
+            if has_kana is None:
+                has_kana = _KANA_PATTERN.search(text) is not None
+            lang = "ja" if has_kana else "zh-CN"
+        elif script == "arabic":
+            if is_urdu is None:
+                is_urdu = _URDU_PATTERN.search(text) is not None
+            lang = "ur" if is_urdu else "ar"
+        else:
+            lang = SCRIPT_LANGUAGES[script]
+        yield match.start(), match.end(), lang
+
+def split_language_spans(text, default_lang='en'):
     """
-    Generate audio for a complete story, handling long texts by splitting them.
+    Split mixed-language text into consecutive spans that each use one TTS language.
+    
+    Spaces, digits and punctuation stay with the span they follow, so joining the
+    span texts gives back the original text.
     
     Args:
-    story_text (str): The complete story text.
-    lang (str): The language of the text.
+    text (str): The text to split.
+    default_lang (str): The language used for Latin-script text.
     
     Returns:
-    bytes: The complete audio data as bytes.
+    list: (lang, text) tuples in order.
     """
-    chunks = split_text(story_text)
-    audio_segments = []
-
-    for chunk in chunks:
-        audio_bytes = text_to_speech(chunk, lang)
-        if audio_bytes:
-            audio_segment = AudioSegment.from_mp3(io.BytesIO(audio_bytes))
-            audio_segments.append(audio_segment)
-
-    if audio_segments:
-        combined_audio = sum(audio_segments)
-        buffer = io.BytesIO()
-        combined_audio.export(buffer, format="mp3")
-        return buffer.getvalue()
-    else:
-        return None
+    spans = []
+    for start, end, lang in _script_runs(text, default_lang):
+        if spans and spans[-1][0] == lang:
+            spans[-1][2] = end
+        elif spans:
+            spans[-1][2] = start
+            spans.append([lang, start, end])
+        else:
+            spans.append([lang, 0, end])
+    if not spans:
+        return [(default_lang, text)] if text else []
+    spans[-1][2] = len(text)
+    return [(lang, text[start:end]) for lang, start, end in spans]
 
-def detect_language(text):
+def detect_language(text, default_lang='en'):
     """
-    Detect the language of the given text.
-    This is a placeholder function. You might want to use a more sophisticated
-    language detection library like langdetect or google-cloud-translate.
+    Detect the dominant language of the given text from its scripts.
     
     Args:
     text (str): The text to detect the language for.
+    default_lang (str): The language assumed for Latin-script text.
     
     Returns:
-    str: The detected language code.
+    str: The language code with the most letters in the text.
     """
-    # This is a very basic detection. In a real application, you'd want to use
-    # a more robust method.
-    if any('\u4e00' <= char <= '\u9fff' for char in text):
-        return 'zh-cn'  # Chinese
-    elif any('\u3040' <= char <= '\u30ff' for char in text):
-        return 'ja'  # Japanese
-    elif any('\uac00' <= char <= '\ud7a3' for char in text):
-        return 'ko'  # Korean
-    # Add more language checks as needed
-    else:
-        return 'en'  # Default to English
+    letters = {}
+    for start, end, lang in _script_runs(text, default_lang):
+        letters[lang] = letters.get(lang, 0) + end - start
+    return max(letters, key=letters.get) if letters else default_lang
 
 def adjust_speech_rate(audio_segment, speed_factor=1.0):
     """
@@ -1,146 +1,515 @@
+import base64
 import hashlib
+import hmac
 import sqlite3
-from database import get_database_connection
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from database import get_cursor, get_read_cursor
+from config import get_setting
 import secrets
 import string
 import logging
 
+# Passwords are hashed with scrypt, a salted, memory-hard KDF, and stored as
+# "scrypt$n=16384,r=8,p=1$<salt>$<hash>" so each hash records its own cost.
+# Hashes from before this format are unsalted SHA-256 hex digests; they still
+# verify and are upgraded on the next successful login.
+SCRYPT_PREFIX = "scrypt"
+SCRYPT_R = 8
+SCRYPT_P = 1
+SCRYPT_KEY_LENGTH = 32
+SALT_BYTES = 16
+# Auto-tuning picks the largest power-of-two n whose hash fits the login budget
+# and whose working memory (about 128 * r * n bytes) fits the memory budget,
+# which applies to each of the PASSWORD_HASH_WORKERS hashes running at once
+MIN_SCRYPT_N = 2 ** 14
+MAX_SCRYPT_N = 2 ** 20
+DEFAULT_HASH_BUDGET_MS = 100
+DEFAULT_HASH_MAX_MEMORY_MB = 64
+# At most this many hashes run at once, however many logins arrive together
+DEFAULT_KDF_WORKERS = 2
+
+# Seconds a user's existence/confirmation status is served from memory. Entries
+# are dropped on every write through this module, so the TTL only bounds how
+# long another process's writes can go unnoticed.
+DEFAULT_USER_STATUS_TTL = 60
+# Emails come from user input, so the cache keeps at most this many (LRU)
+DEFAULT_USER_STATUS_MAX_ENTRIES = 10000
+PLACEHOLDER_PASSWORD = "PLACEHOLDER_PASSWORD"
+
+# One-time tokens are stored only as SHA-256 hashes in the tokens table, each
+# with a purpose and an expiry, and are marked used when redeemed.
+CONFIRMATION = "confirmation"
+RESET = "reset"
+DEFAULT_TOKEN_TTLS = {CONFIRMATION: 24 * 3600, RESET: 3600}
+# Expired and used tokens are deleted in batches of this size, each its own
+# short transaction, so the sweeper never holds the write lock for long
+TOKEN_SWEEP_INTERVAL = 300
+TOKEN_SWEEP_BATCH_SIZE = 500
+
+_hash_params = None
+_hash_params_lock = threading.Lock()
+_hash_tuning = None
+_hash_tuning_lock = threading.Lock()
+_kdf_executor = None
+_kdf_executor_lock = threading.Lock()
+
+def _get_kdf_executor():
+    global _kdf_executor
+    with _kdf_executor_lock:
+        if _kdf_executor is None:
+            _kdf_executor = ThreadPoolExecutor(
+                max_workers=int(get_setting("PASSWORD_HASH_WORKERS", DEFAULT_KDF_WORKERS)),
+                thread_name_prefix="storify-kdf",
+            )
+        return _kdf_executor
+
+def scrypt_memory(n, r=SCRYPT_R, p=SCRYPT_P):
+    """
+    Return the bytes OpenSSL allocates for one scrypt hash with the given cost,
+    used as its maxmem limit.
+    """
+    return 128 * r * (n + p + 2)
+
+def max_scrypt_n(max_memory_bytes, r=SCRYPT_R):
+    """
+    Return the largest power-of-two n (between MIN_SCRYPT_N and MAX_SCRYPT_N)
+    whose 128 * r * n byte working set fits in the memory budget.
+    """
+    n = MIN_SCRYPT_N
+    while n < MAX_SCRYPT_N and 128 * r * n * 2 <= max_memory_bytes:
+        n *= 2
+    return n
+
+def _scrypt(password, salt, n, r, p):
+    # maxmem matches what this cost needs, instead of OpenSSL's 32 MiB default
+    return hashlib.scrypt(password.encode(), salt=salt, n=n, r=r, p=p, maxmem=scrypt_memory(n, r, p), dklen=SCRYPT_KEY_LENGTH)
+
+def time_scrypt(n, r=SCRYPT_R, p=SCRYPT_P):
+    """
+    Return the seconds one scrypt hash takes on this host with the given cost.
+    """
+    start = time.perf_counter()
+    _scrypt("benchmark password", b"\0" * SALT_BYTES, n, r, p)
+    return time.perf_counter() - start
+
+def tune_scrypt_cost(budget_seconds, r=SCRYPT_R, p=SCRYPT_P, max_n=MAX_SCRYPT_N):
+    """
+    Return the largest power-of-two n (at least MIN_SCRYPT_N, at most max_n)
+    whose hash takes no longer than the budget on this host.
+    """
+    n = MIN_SCRYPT_N
+    while n < max_n and time_scrypt(n * 2, r, p) <= budget_seconds:
+        n *= 2
+    return n
+
+def get_password_hash_params():
+    """
+    Return the (n, r, p) used for new hashes. n comes from the PASSWORD_HASH_N
+    secret, or is tuned once per process to the PASSWORD_HASH_BUDGET_MS budget.
+    Either way it is capped so one hash fits in PASSWORD_HASH_MAX_MEMORY_MB.
+    """
+    global _hash_params
+    with _hash_params_lock:
+        if _hash_params is None:
+            r = int(get_setting("PASSWORD_HASH_R", SCRYPT_R))
+            p = int(get_setting("PASSWORD_HASH_P", SCRYPT_P))
+            max_memory_mb = float(get_setting("PASSWORD_HASH_MAX_MEMORY_MB", DEFAULT_HASH_MAX_MEMORY_MB))
+            max_n = max_scrypt_n(max_memory_mb * 2 ** 20, r)
+            n = get_setting("PASSWORD_HASH_N")
+            if n is None:
+                budget_seconds = float(get_setting("PASSWORD_HASH_BUDGET_MS", DEFAULT_HASH_BUDGET_MS)) / 1000
+                n = tune_scrypt_cost(budget_seconds, r, p, max_n)
+                logging.info(f"Tuned scrypt to n={n}, r={r}, p={p} for a {budget_seconds * 1000:.0f} ms budget")
+            elif int(n) > max_n:
+                logging.warning(f"PASSWORD_HASH_N={n} needs more than {max_memory_mb:.0f} MiB per hash; using n={max_n}")
+                n = max_n
+            _hash_params = (int(n), r, p)
+        return _hash_params
+
+def start_password_hash_tuning():
+    """
+    Work out the scrypt parameters once per process, in the background on the
+    KDF executor, so no login waits for the tuning runs on its own thread.
+    """
+    global _hash_tuning
+    with _hash_tuning_lock:
+        if _hash_tuning is None:
+            _hash_tuning = _get_kdf_executor().submit(get_password_hash_params)
+
+def _encode_hash(salt, key, n, r, p):
+    encode = lambda data: base64.b64encode(data).decode().rstrip("=")
+    return f"{SCRYPT_PREFIX}$n={n},r={r},p={p}${encode(salt)}${encode(key)}"
+
+def _decode_hash(encoded):
+    _, params, salt, key = encoded.split("$")
+    cost = dict(param.split("=") for param in params.split(","))
+    decode = lambda text: base64.b64decode(text + "=" * (-len(text) % 4))
+    return decode(salt), decode(key), int(cost["n"]), int(cost["r"]), int(cost["p"])
+
+def _hash_password(password):
+    # Runs on the KDF executor, so the first hash in a process tunes there if needed
+    n, r, p = get_password_hash_params()
+    salt = secrets.token_bytes(SALT_BYTES)
+    return _encode_hash(salt, _scrypt(password, salt, n, r, p), n, r, p)
+
+def _verify_password(password, encoded):
+    if not encoded.startswith(SCRYPT_PREFIX + "$"):
+        legacy = hashlib.sha256(password.encode()).hexdigest()
+        return hmac.compare_digest(legacy, encoded)
+    salt, key, n, r, p = _decode_hash(encoded)
+    return hmac.compare_digest(_scrypt(password, salt, n, r, p), key)
+
 def hash_password(password):
     """
     Hash a password for storing.
     """
-    return hashlib.sha256(password.encode()).hexdigest()
+    return _get_kdf_executor().submit(_hash_password, password).result()
+
+def verify_password(password, encoded):
+    """
+    Check a password against a stored hash in either the scrypt or the legacy format.
+    """
+    try:
+        return _get_kdf_executor().submit(_verify_password, password, encoded).result()
+    except (ValueError, KeyError) as e:
+        logging.error(f"Malformed password hash: {str(e)}")
+        return False
+
+def needs_rehash(encoded):
+    """
+    Return True for legacy hashes and scrypt hashes weaker than the current parameters.
+    """
+    if not encoded.startswith(SCRYPT_PREFIX + "$"):
+        return True
+    if _hash_params is None:
+        # Still tuning; check again on a later login rather than wait here
+        return False
+    _, _, n, r, p = _decode_hash(encoded)
+    current_n, current_r, current_p = _hash_params
+    return n * r * p < current_n * current_r * current_p
+
+def _rehash_password(email, password, old_hash):
+    new_hash = hash_password(password)
+    try:
+        with get_cursor() as c:
+            # Only replace the hash we verified, in case the password changed meanwhile
+            c.execute("UPDATE users SET password = ? WHERE email = ? AND password = ?", (new_hash, email, old_hash))
+        logging.info(f"Upgraded password hash for {email}")
+    except sqlite3.Error as e:
+        logging.error(f"Error upgrading password hash: {str(e)}")
+
+@dataclass(frozen=True)
+class UserRecord:
+    """The columns of a users row that authentication needs, by name."""
+    id: int
+    email: str
+    password: str
+    is_confirmed: bool
+
+USER_RECORD_SQL = "SELECT id, email, password, is_confirmed FROM users WHERE email = ?"
+
+class UserStatusCache:
+    """
+    Existence and confirmation status per email, kept for `ttl` seconds.
+    Only status is cached; password hashes and tokens are always read from the database.
+    At most `max_entries` emails are kept, least recently used first out.
+    """
+
+    def __init__(self, ttl=DEFAULT_USER_STATUS_TTL, max_entries=DEFAULT_USER_STATUS_MAX_ENTRIES):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, email):
+        """Return (exists, is_confirmed), or None if the entry is missing or expired."""
+        with self._lock:
+            entry = self._entries.get(email)
+            if entry is None:
+                return None
+            expires_at, status = entry
+            if expires_at < time.monotonic():
+                del self._entries[email]
+                return None
+            self._entries.move_to_end(email)
+            return status
+
+    def put(self, email, exists, is_confirmed):
+        now = time.monotonic()
+        with self._lock:
+            self._entries[email] = (now + self.ttl, (exists, is_confirmed))
+            self._entries.move_to_end(email)
+            # Drop expired entries from the least recently used end, then enforce the size limit
+            while self._entries and next(iter(self._entries.values()))[0] < now:
+                self._entries.popitem(last=False)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, email):
+        with self._lock:
+            self._entries.pop(email, None)
+
+_user_status_cache = None
+_user_status_cache_lock = threading.Lock()
+
+def get_user_status_cache():
+    global _user_status_cache
+    with _user_status_cache_lock:
+        if _user_status_cache is None:
+            _user_status_cache = UserStatusCache(
+                float(get_setting("USER_STATUS_TTL", DEFAULT_USER_STATUS_TTL)),
+                int(get_setting("USER_STATUS_MAX_ENTRIES", DEFAULT_USER_STATUS_MAX_ENTRIES)),
+            )
+        return _user_status_cache
+
+def get_user_record(email):
+    """
+    Fetch the user's authentication columns in one query and refresh the status cache.
+
+    Returns:
+    UserRecord: The user, or None if there is no user with this email.
+    """
+    with get_read_cursor() as c:
+        c.execute(USER_RECORD_SQL, (email,))
+        row = c.fetchone()
+    if row is None:
+        get_user_status_cache().put(email, False, False)
+        return None
+    user = UserRecord(row[0], row[1], row[2], bool(row[3]))
+    get_user_status_cache().put(email, True, user.is_confirmed)
+    return user
+
+def get_user_status(email):
+    """
+    Return (exists, is_confirmed) for an email, from the cache when possible.
+    """
+    status = get_user_status_cache().get(email)
+    if status is None:
+        user = get_user_record(email)
+        status = (user is not None, user is not None and user.is_confirmed)
+    return status
+
+def hash_token(token):
+    return hashlib.sha256(token.encode()).hexdigest()
+
+def _token_ttl(purpose):
+    return int(get_setting(f"{purpose.upper()}_TOKEN_TTL_SECONDS", DEFAULT_TOKEN_TTLS[purpose]))
+
+def _issue_token(c, email, token, purpose):
+    # A new token replaces any earlier one for the same user and purpose
+    c.execute("SELECT id FROM users WHERE email = ?", (email,))
+    row = c.fetchone()
+    if row is None:
+        return False
+    now = int(time.time())
+    c.execute("DELETE FROM tokens WHERE user_id = ? AND purpose = ?", (row[0], purpose))
+    c.execute(
+        "INSERT INTO tokens (token_hash, user_id, purpose, created_at, expires_at) VALUES (?, ?, ?, ?, ?)",
+        (hash_token(token), row[0], purpose, now, now + _token_ttl(purpose)),
+    )
+    return True
+
+def _check_token(c, email, token, purpose):
+    """
+    Return the id of the user a valid, unused token was issued to, or None.
+    The token is found with one primary-key probe on its hash.
+    """
+    token_hash = hash_token(token)
+    c.execute("""
+    SELECT tokens.token_hash, tokens.user_id, users.email FROM tokens JOIN users ON users.id = tokens.user_id
+    WHERE tokens.token_hash = ? AND tokens.purpose = ? AND tokens.used_at IS NULL AND tokens.expires_at > ?
+    """, (token_hash, purpose, int(time.time())))
+    row = c.fetchone()
+    if row is None:
+        return None
+    if not (hmac.compare_digest(row[0], token_hash) and hmac.compare_digest(row[2].encode(), email.encode())):
+        return None
+    return row[1]
+
+def _redeem_token(c, email, token, purpose):
+    """
+    Check a token and mark it used in the caller's transaction.
+    Used tokens are also expired so the sweeper removes them.
+    """
+    user_id = _check_token(c, email, token, purpose)
+    if user_id is None:
+        return None
+    now = int(time.time())
+    c.execute("UPDATE tokens SET used_at = ?, expires_at = ? WHERE token_hash = ? AND used_at IS NULL", (now, now, hash_token(token)))
+    return user_id if c.rowcount > 0 else None
+
+def sweep_expired_tokens(batch_size=TOKEN_SWEEP_BATCH_SIZE):
+    """
+    Delete expired (including used) tokens in batches.
+
+    Returns:
+    int: The number of tokens deleted.
+    """
+    deleted = 0
+    now = int(time.time())
+    while True:
+        with get_cursor() as c:
+            c.execute(
+                "DELETE FROM tokens WHERE token_hash IN (SELECT token_hash FROM tokens WHERE expires_at <= ? LIMIT ?)",
+                (now, batch_size),
+            )
+            count = c.rowcount
+        deleted += count
+        if count < batch_size:
+            return deleted
+
+_token_sweeper = None
+_token_sweeper_lock = threading.Lock()
+
+def _sweep_tokens_forever(interval):
+    while True:
+        try:
+            deleted = sweep_expired_tokens()
+            if deleted:
+                logging.info(f"Deleted {deleted} expired tokens")
+        except sqlite3.Error as e:
+            logging.error(f"Error sweeping expired tokens: {str(e)}")
+        time.sleep(interval)
+
+def start_token_sweeper():
+    """
+    Start the process-wide background thread that deletes expired tokens, once.
+    """
+    global _token_sweeper
+    with _token_sweeper_lock:
+        if _token_sweeper is None:
+            interval = float(get_setting("TOKEN_SWEEP_INTERVAL", TOKEN_SWEEP_INTERVAL))
+            _token_sweeper = threading.Thread(target=_sweep_tokens_forever, args=(interval,), name="storify-token-sweeper", daemon=True)
+            _token_sweeper.start()
 
 def verify_user(email, password):
     """
     Verify a email/password combination.
     """
-    conn = get_database_connection()
-    c = conn.cursor()
-    c.execute("SELECT * FROM users WHERE email=?", (email,))
-    user = c.fetchone()
-    c.close()
+    user = get_user_record(email)
 
     if user is None:
         return False, "User not found"
     
-    if user[6] == 0:  # Assuming the 7th column (index 6) is is_confirmed
+    if not user.is_confirmed:
         return False, "Email not confirmed"
     
-    if user[3] != hash_password(password):  # Assuming the 4th column (index 3) is password
+    if not verify_password(password, user.password):
         return False, "Incorrect password"
     
+    if needs_rehash(user.password):
+        _rehash_password(email, password, user.password)
+    
     return True, "Login successful"
 
+def complete_signup(email, token, password):
+    """
+    Redeem a confirmation token and, if it is valid, confirm the user and set
+    their password in the same transaction.
+    """
+    password_hash = hash_password(password)
+    try:
+        with get_cursor() as c:
+            user_id = _redeem_token(c, email, token, CONFIRMATION)
+            if user_id is not None:
+                c.execute("UPDATE users SET password = ?, is_confirmed = 1 WHERE id = ?", (password_hash, user_id))
+    except sqlite3.Error as e:
+        logging.error(f"Database error completing sign-up: {str(e)}")
+        return False
+    get_user_status_cache().invalidate(email)
+    return user_id is not None
+
+def reset_password(email, token, new_password):
+    """
+    Redeem a reset token and, if it is valid, set the new password in the same transaction.
+    """
+    password_hash = hash_password(new_password)
+    try:
+        with get_cursor() as c:
+            user_id = _redeem_token(c, email, token, RESET)
+            if user_id is not None:
+                c.execute("UPDATE users SET password = ? WHERE id = ?", (password_hash, user_id))
+        return user_id is not None
+    except sqlite3.Error as e:
+        logging.error(f"Database error resetting password: {str(e)}")
+        return False
+
 def add_user(email, password):
     """
     Add a new user to the database with confirmed status.
     """
-    conn = get_database_connection()
-    c = conn.cursor()
+    # Hash before opening the transaction so the KDF doesn't hold the write lock
+    password_hash = hash_password(password)
     try:
-        c.execute("UPDATE users SET password = ?, is_confirmed = 1, confirmation_token = NULL WHERE email = ?", 
-                  (hash_password(password), email))
-        conn.commit()
-        c.close()
+        with get_cursor() as c:
+            c.execute("UPDATE users SET password = ?, is_confirmed = 1 WHERE email = ?", 
+                      (password_hash, email))
         return True
     except sqlite3.Error:
-        c.close()
         return False
-
-def get_confirmation_token(email):
-    """
-    Retrieve the confirmation token for a given email.
-    """
-    conn = get_database_connection()
-    c = conn.cursor()
-    c.execute("SELECT confirmation_token FROM users WHERE email=?", (email,))
-    result = c.fetchone()
-    c.close()
-    return result[0] if result else None
+    finally:
+        get_user_status_cache().invalidate(email)
 
 def confirm_email(email, token):
     """
     Confirm a user's email using the confirmation token.
     """
-    conn = get_database_connection()
-    c = conn.cursor()
     try:
-        # Log the input values
-        logging.info(f"Attempting to confirm email: {email} with token: {token}")
+        logging.info(f"Attempting to confirm email: {email}")
 
-        # First, check if the email exists
-        c.execute("SELECT confirmation_token FROM users WHERE email = ?", (email,))
-        result = c.fetchone()
-        
-        if result is None:
-            logging.warning(f"No user found with email {email}")
-            return False
-        
-        stored_token = result[0]
-        logging.info(f"Stored token for {email}: {stored_token}")
+        with get_cursor() as c:
+            user_id = _redeem_token(c, email, token, CONFIRMATION)
+            if user_id is not None:
+                c.execute("UPDATE users SET is_confirmed = 1 WHERE id = ?", (user_id,))
+            result = user_id is not None
+        get_user_status_cache().invalidate(email)
         
-        if stored_token != token:
-            logging.warning(f"Token mismatch for {email}. Provided: {token}, Stored: {stored_token}")
-            return False
-        
-        # If tokens match, update the confirmation status
-        c.execute("UPDATE users SET is_confirmed = 1, confirmation_token = NULL WHERE email = ?", (email,))
-        conn.commit()
-        
-        result = c.rowcount > 0
         if result:
             logging.info(f"Email confirmed successfully for user {email}")
         else:
-            logging.warning(f"Failed to update confirmation status for user {email}")
+            logging.warning(f"Invalid or expired confirmation token for {email}")
         
-        c.close()
         return result
     except sqlite3.Error as e:
         logging.error(f"Database error during email confirmation: {str(e)}")
-        c.close()
         return False
 
 def change_password(email, new_password):
     """
     Change the password for an existing user.
     """
-    conn = get_database_connection()
-    c = conn.cursor()
+    password_hash = hash_password(new_password)
     try:
-        c.execute("UPDATE users SET password = ? WHERE email = ?", (hash_password(new_password), email))
-        conn.commit()
-        c.close()
+        with get_cursor() as c:
+            c.execute("UPDATE users SET password = ? WHERE email = ?", (password_hash, email))
         return True
     except sqlite3.Error:
-        c.close()
         return False
 
 def delete_user(email):
     """
     Delete a user from the database.
     """
-    conn = get_database_connection()
-    c = conn.cursor()
     try:
-        c.execute("DELETE FROM users WHERE email = ?", (email,))
-        conn.commit()
-        c.close()
+        with get_cursor() as c:
+            c.execute("DELETE FROM tokens WHERE user_id IN (SELECT id FROM users WHERE email = ?)", (email,))
+            c.execute("DELETE FROM users WHERE email = ?", (email,))
         return True
     except sqlite3.Error:
-        c.close()
         return False
+    finally:
+        get_user_status_cache().invalidate(email)
 
 def user_exists(email):
     """
     Check if a user exists in the database.
     """
-    conn = get_database_connection()
-    c = conn.cursor()
-    c.execute("SELECT * FROM users WHERE email=?", (email,))
-    result = c.fetchone()
-    c.close()
-    return result is not None
+    exists, _ = get_user_status(email)
+    return exists
 
 def generate_confirmation_token():
     """
@@ -152,35 +521,22 @@ def generate_reset_token():
     return ''.join(secrets.choice(string.ascii_letters + string.digits) for _ in range(32))
 
 def store_reset_token(email, token):
-    conn = get_database_connection()
-    c = conn.cursor()
     try:
-        c.execute("UPDATE users SET reset_token = ? WHERE email = ?", (token, email))
-        conn.commit()
-        c.close()
-        return True
+        with get_cursor() as c:
+            return _issue_token(c, email, token, RESET)
     except sqlite3.Error:
-        c.close()
         return False
 
 def verify_reset_token(email, token):
-    conn = get_database_connection()
-    c = conn.cursor()
-    c.execute("SELECT * FROM users WHERE email=? AND reset_token=?", (email, token))
-    result = c.fetchone()
-    c.close()
-    return result is not None
+    with get_read_cursor() as c:
+        return _check_token(c, email, token, RESET) is not None
 
 def clear_reset_token(email):
-    conn = get_database_connection()
-    c = conn.cursor()
     try:
-        c.execute("UPDATE users SET reset_token = NULL WHERE email = ?", (email,))
-        conn.commit()
-        c.close()
+        with get_cursor() as c:
+            c.execute("DELETE FROM tokens WHERE purpose = ? AND user_id IN (SELECT id FROM users WHERE email = ?)", (RESET, email))
         return True
     except sqlite3.Error:
-        c.close()
         return False
 
 def store_confirmation_token(email, token):
@@ -189,45 +545,28 @@ def store_confirmation_token(email, token):
     """
     try:
         logging.info(f"Attempting to store confirmation token for email: {email}")
-        conn = get_database_connection()
-        c = conn.cursor()
-        
-        # Check if the user already exists
-        c.execute("SELECT * FROM users WHERE email = ?", (email,))
-        existing_user = c.fetchone()
-        
-        if existing_user:
-            logging.info(f"Updating existing user with email: {email}")
-            c.execute("UPDATE users SET confirmation_token = ?, is_confirmed = 0 WHERE email = ?", 
-                      (token, email))
-        else:
-            logging.info(f"Inserting new user with email: {email}")
-            # Use a placeholder password when creating a new user
-            placeholder_password = "PLACEHOLDER_PASSWORD"
-            c.execute("INSERT INTO users (email, password, confirmation_token, is_confirmed) VALUES (?, ?, ?, 0)", 
-                      (email, placeholder_password, token))
+        with get_cursor() as c:
+            # New users get a placeholder password until they complete sign-up;
+            # existing users get a fresh token and must confirm again
+            c.execute("""
+            INSERT INTO users (email, password, is_confirmed) VALUES (?, ?, 0)
+            ON CONFLICT(email) DO UPDATE SET is_confirmed = 0
+            """, (email, PLACEHOLDER_PASSWORD))
+            _issue_token(c, email, token, CONFIRMATION)
+        get_user_status_cache().invalidate(email)
         
-        conn.commit()
         logging.info(f"Confirmation token stored successfully for email: {email}")
         return True
     except sqlite3.Error as e:
         logging.error(f"SQLite error in store_confirmation_token: {str(e)}")
-        if conn:
-            conn.rollback()
         return False
     except Exception as e:
         logging.error(f"Unexpected error in store_confirmation_token: {str(e)}")
-        if conn:
-            conn.rollback()
         return False
 
 def verify_confirmation_token(email, token):
     """
     Verify the confirmation token for a user.
     """
-    conn = get_database_connection()
-    c = conn.cursor()
-    c.execute("SELECT * FROM users WHERE email=? AND confirmation_token=?", (email, token))
-    result = c.fetchone()
-    c.close()
-    return result is not None
\ No newline at end of file
+    with get_read_cursor() as c:
+        return _check_token(c, email, token, CONFIRMATION) is not None
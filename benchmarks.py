@@ -0,0 +1,351 @@
+"""
+Micro- and load benchmarks for Storify.
+
+Run a single benchmark with, for example:
+
+    python benchmarks.py sd-cpu --model-id runwayml/stable-diffusion-v1-5
+"""
+import argparse
+import logging
+import statistics
+import time
+
+def benchmark_stable_diffusion_cpu(model_id, sizes=(256, 512), steps=20, runs=2, scheduler="dpm++", cpu_dtype="fp32", num_threads=None):
+    """
+    Report seconds per image for the CPU Stable Diffusion pipeline at each size.
+    The first (warm-up) image of each size is excluded.
+    """
+    import torch
+    from image_generation import load_stable_diffusion_model
+
+    pipe = load_stable_diffusion_model(model_id, scheduler, cpu_dtype, num_threads)
+    print(f"{model_id} on {'cuda' if torch.cuda.is_available() else 'cpu'}, {scheduler}, {cpu_dtype}, {steps} steps, {torch.get_num_threads()} threads")
+    for size in sizes:
+        timings = []
+        for run in range(runs + 1):
+            start = time.perf_counter()
+            with torch.inference_mode():
+                pipe("A lighthouse on a cliff at sunset", height=size, width=size, num_inference_steps=steps)
+            if run:
+                timings.append(time.perf_counter() - start)
+        print(f"{size}x{size}: {statistics.median(timings):.2f} s/image (median of {runs})")
+
+def benchmark_stable_diffusion_batch(model_id, num_scenes=4, size=256, steps=20):
+    """
+    Compare one batched pipeline call for N scene prompts against N separate calls
+    on the same loaded pipeline.
+    """
+    import torch
+    from image_generation import extract_scenes, load_stable_diffusion_model
+
+    story = " ".join(f"Scene {i} shows a different place in the kingdom. The hero travels on." for i in range(num_scenes))
+    prompts = extract_scenes(story, num_scenes)
+    pipe = load_stable_diffusion_model(model_id)
+    options = {"height": size, "width": size, "num_inference_steps": steps}
+    with torch.inference_mode():
+        pipe(prompts[0], **options)  # warm-up
+
+        start = time.perf_counter()
+        for prompt in prompts:
+            pipe(prompt, **options)
+        separate = time.perf_counter() - start
+
+        start = time.perf_counter()
+        pipe(prompt=prompts, **options)
+        batched = time.perf_counter() - start
+
+    print(f"{len(prompts)} scenes at {size}x{size}, {steps} steps")
+    print(f"separate calls: {separate:.2f} s ({separate / len(prompts):.2f} s/image)")
+    print(f"one batched call: {batched:.2f} s ({batched / len(prompts):.2f} s/image)")
+
+def _legacy_split_text(text, max_length=5000):
+    # The previous audio_generation.split_text, kept for comparison: it re-joins
+    # the current chunk for every word, which is quadratic in chunk length.
+    words = text.split()
+    chunks = []
+    current_chunk = []
+    for word in words:
+        if len(' '.join(current_chunk + [word])) <= max_length:
+            current_chunk.append(word)
+        else:
+            chunks.append(' '.join(current_chunk))
+            current_chunk = [word]
+    if current_chunk:
+        chunks.append(' '.join(current_chunk))
+    return chunks
+
+def benchmark_split_text(num_words=100_000, max_length=5000, runs=3):
+    """
+    Time the sentence-aware linear chunker against the legacy word-join splitter.
+    """
+    import random
+    from utils import chunk_text
+
+    rng = random.Random(0)
+    vocabulary = ["the", "dragon", "whispered", "softly", "to", "a", "curious", "student", "about", "kanji"]
+    words = []
+    for i in range(num_words):
+        word = rng.choice(vocabulary)
+        words.append(word + "." if i % 12 == 11 else word)
+    text = " ".join(words)
+
+    for name, splitter in [("legacy split_text", _legacy_split_text), ("chunk_text", chunk_text)]:
+        timings = []
+        for _ in range(runs):
+            start = time.perf_counter()
+            chunks = splitter(text, max_length)
+            timings.append(time.perf_counter() - start)
+        print(f"{name}: {statistics.median(timings) * 1000:.1f} ms for {num_words} words -> {len(chunks)} chunks")
+
+class _DatabaseErrorCounter(logging.Handler):
+    """
+    Count database errors that the auth helpers log and turn into a False
+    return value, split into lock timeouts and constraint violations.
+    """
+
+    def __init__(self):
+        super().__init__(logging.ERROR)
+        self.locked = 0
+        self.integrity = 0
+
+    def emit(self, record):
+        message = record.getMessage()
+        with self.lock:
+            if "database is locked" in message:
+                self.locked += 1
+            elif "constraint failed" in message:
+                self.integrity += 1
+
+def benchmark_database_load(workers=16, users_per_worker=25, stories_per_user=4):
+    """
+    Concurrent sign-ups, logins and story writes against a temporary database,
+    counting "database is locked" errors and constraint violations separately.
+    """
+    import os
+    import sqlite3
+    import tempfile
+    from concurrent.futures import ThreadPoolExecutor
+
+    import database
+    from auth import complete_signup, generate_confirmation_token, store_confirmation_token, verify_user
+
+    directory = tempfile.mkdtemp()
+    database.configure_database(os.path.join(directory, "load_test.db"))
+    logged_errors = _DatabaseErrorCounter()
+    logging.getLogger().addHandler(logged_errors)
+
+    def worker(number):
+        timings = []
+        counts = {"locked": 0, "integrity": 0, "failed": 0}
+        for i in range(users_per_worker):
+            email = f"user{number}-{i}@example.com"
+            start = time.perf_counter()
+            try:
+                # The auth helpers log and return False on database errors
+                token = generate_confirmation_token()
+                signed_up = store_confirmation_token(email, token) and complete_signup(email, token, "correct horse battery staple")
+                logged_in, _ = verify_user(email, "correct horse battery staple")
+                if not (signed_up and logged_in):
+                    counts["failed"] += 1
+                    continue
+                user_id = database.get_user_id(email)
+                for n in range(stories_per_user):
+                    database.queue_story(user_id, f"Story {n}", "Once upon a time...", "Fantasy", prompt="A dragon")
+                database.flush_story_writes()
+                database.get_user_stories(user_id, limit=10)
+            except sqlite3.IntegrityError:
+                counts["integrity"] += 1
+            except sqlite3.OperationalError as e:
+                counts["locked" if "locked" in str(e) else "failed"] += 1
+            timings.append(time.perf_counter() - start)
+        return timings, counts
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        results = list(executor.map(worker, range(workers)))
+    elapsed = time.perf_counter() - start
+    logging.getLogger().removeHandler(logged_errors)
+
+    timings = sorted(t for worker_timings, _ in results for t in worker_timings)
+    totals = {key: sum(counts[key] for _, counts in results) for key in ("locked", "integrity", "failed")}
+    with database.get_read_cursor() as cursor:
+        cursor.execute("SELECT COUNT(*) FROM stories")
+        story_count = cursor.fetchone()[0]
+    database.close_database_connections()
+    print(f"{workers} workers, {workers * users_per_worker} sign-ups, {story_count} stories in {elapsed:.2f} s")
+    if timings:
+        print(f"p50 {statistics.median(timings) * 1000:.1f} ms, p95 {timings[int(len(timings) * 0.95)] * 1000:.1f} ms per sign-up")
+    print(f"'database is locked' errors: {totals['locked'] + logged_errors.locked}")
+    print(f"Constraint violations: {totals['integrity'] + logged_errors.integrity}")
+    print(f"Failed sign-ups: {totals['failed'] + totals['locked'] + totals['integrity']}")
+
+def benchmark_password_hash(budget_ms=100, logins=16):
+    """
+    Show scrypt cost per work factor on this host, the factor auto-tuning picks
+    for the budget, and login latency for a burst through the bounded KDF executor.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    from auth import (
+        DEFAULT_HASH_MAX_MEMORY_MB, MAX_SCRYPT_N, MIN_SCRYPT_N, hash_password, max_scrypt_n,
+        scrypt_memory, time_scrypt, tune_scrypt_cost, verify_password,
+    )
+
+    n = MIN_SCRYPT_N // 4
+    while n <= MAX_SCRYPT_N // 4:
+        print(f"n={n}: {time_scrypt(n) * 1000:.1f} ms, {scrypt_memory(n) / 2 ** 20:.0f} MiB")
+        n *= 2
+    max_n = max_scrypt_n(DEFAULT_HASH_MAX_MEMORY_MB * 2 ** 20)
+    print(f"largest n within {DEFAULT_HASH_MAX_MEMORY_MB} MiB per hash: {max_n}")
+    print(f"tuned n for a {budget_ms} ms budget: {tune_scrypt_cost(budget_ms / 1000, max_n=max_n)}")
+
+    encoded = hash_password("correct horse battery staple")
+    def login(_):
+        start = time.perf_counter()
+        verify_password("correct horse battery staple", encoded)
+        return time.perf_counter() - start
+    with ThreadPoolExecutor(max_workers=logins) as executor:
+        timings = sorted(executor.map(login, range(logins)))
+    print(f"{logins} concurrent logins: p50 {statistics.median(timings) * 1000:.1f} ms, max {timings[-1] * 1000:.1f} ms")
+
+class _SMTPSink:
+    """
+    Minimal local SMTP server that accepts and discards mail, standing in for
+    a real mail server. `reply_delay` simulates a slow server on each command.
+    """
+
+    def __init__(self, reply_delay=0.0):
+        self.reply_delay = reply_delay
+        self.connections = 0
+        self.messages = 0
+        self.port = None
+
+    def start(self):
+        import asyncio
+        import threading
+
+        loop = asyncio.new_event_loop()
+        started = threading.Event()
+
+        async def serve():
+            server = await asyncio.start_server(self._handle, "127.0.0.1", 0)
+            self.port = server.sockets[0].getsockname()[1]
+            started.set()
+            async with server:
+                await server.serve_forever()
+
+        threading.Thread(target=loop.run_until_complete, args=(serve(),), daemon=True).start()
+        started.wait()
+        return self
+
+    async def _handle(self, reader, writer):
+        import asyncio
+
+        self.connections += 1
+        writer.write(b"220 sink ready\r\n")
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            command = line[:4].upper()
+            await asyncio.sleep(self.reply_delay)
+            if command in (b"EHLO", b"HELO"):
+                writer.write(b"250 sink\r\n")
+            elif command == b"DATA":
+                writer.write(b"354 end with .\r\n")
+                await writer.drain()
+                while await reader.readline() not in (b".\r\n", b""):
+                    pass
+                self.messages += 1
+                writer.write(b"250 queued\r\n")
+            elif command == b"QUIT":
+                writer.write(b"221 bye\r\n")
+                await writer.drain()
+                break
+            else:
+                writer.write(b"250 OK\r\n")
+            await writer.drain()
+        writer.close()
+
+def benchmark_email_outbox(messages=50, reply_delay=0.01):
+    """
+    Send mail to a local SMTP sink: a connection per message with smtplib, as
+    send_email used to, against the queued outbox on one warm connection.
+    """
+    import smtplib
+    from config import Settings
+    from email_utils import EmailOutbox, build_message
+
+    sink = _SMTPSink(reply_delay).start()
+    mail = [build_message("storify@example.com", f"user{i}@example.com", "Benchmark", "Hello") for i in range(messages)]
+
+    start = time.perf_counter()
+    for message in mail:
+        with smtplib.SMTP("127.0.0.1", sink.port) as server:
+            server.ehlo()
+            server.send_message(message)
+    per_connection = time.perf_counter() - start
+    print(f"connection per message: {per_connection:.2f} s for {messages} messages, blocking the caller throughout")
+
+    connections_before = sink.connections
+    outbox = EmailOutbox(Settings({"SMTP_SERVER": "127.0.0.1", "SMTP_PORT": sink.port, "SMTP_STARTTLS": False}))
+    start = time.perf_counter()
+    for message in mail:
+        outbox.send(message)
+    queued = time.perf_counter() - start
+    outbox.wait_until_sent(timeout=60)
+    delivered = time.perf_counter() - start
+    print(f"outbox: queued in {queued * 1000:.1f} ms, delivered in {delivered:.2f} s "
+          f"over {sink.connections - connections_before} connection(s), {outbox.sent} sent, {outbox.failed} failed")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    sd_cpu = subparsers.add_parser("sd-cpu", help="Stable Diffusion seconds per image on CPU")
+    sd_cpu.add_argument("--model-id", default="runwayml/stable-diffusion-v1-5")
+    sd_cpu.add_argument("--sizes", type=int, nargs="+", default=[256, 512])
+    sd_cpu.add_argument("--steps", type=int, default=20)
+    sd_cpu.add_argument("--runs", type=int, default=2)
+    sd_cpu.add_argument("--scheduler", default="dpm++")
+    sd_cpu.add_argument("--dtype", default="fp32", choices=["fp32", "bf16"])
+    sd_cpu.add_argument("--threads", type=int, default=None)
+
+    sd_batch = subparsers.add_parser("sd-batch", help="Batched vs separate Stable Diffusion calls for story scenes")
+    sd_batch.add_argument("--model-id", default="runwayml/stable-diffusion-v1-5")
+    sd_batch.add_argument("--scenes", type=int, default=4)
+    sd_batch.add_argument("--size", type=int, default=256)
+    sd_batch.add_argument("--steps", type=int, default=20)
+
+    split = subparsers.add_parser("split-text", help="Text chunking for TTS on a large input")
+    split.add_argument("--words", type=int, default=100_000)
+    split.add_argument("--max-length", type=int, default=5000)
+
+    db_load = subparsers.add_parser("db-load", help="Concurrent sign-ins and story writes against a temporary SQLite database")
+    db_load.add_argument("--workers", type=int, default=16)
+    db_load.add_argument("--users", type=int, default=25, help="Sign-ups per worker")
+    db_load.add_argument("--stories", type=int, default=4, help="Stories written per user")
+
+    password_hash = subparsers.add_parser("password-hash", help="scrypt cost per work factor and login latency under a burst")
+    password_hash.add_argument("--budget-ms", type=int, default=100)
+    password_hash.add_argument("--logins", type=int, default=16)
+
+    email = subparsers.add_parser("email-outbox", help="Queued email delivery against a local stand-in SMTP server")
+    email.add_argument("--messages", type=int, default=50)
+    email.add_argument("--reply-delay", type=float, default=0.01, help="Seconds the stand-in server takes per command")
+
+    args = parser.parse_args()
+    if args.benchmark == "sd-cpu":
+        benchmark_stable_diffusion_cpu(args.model_id, args.sizes, args.steps, args.runs, args.scheduler, args.dtype, args.threads)
+    elif args.benchmark == "sd-batch":
+        benchmark_stable_diffusion_batch(args.model_id, args.scenes, args.size, args.steps)
+    elif args.benchmark == "split-text":
+        benchmark_split_text(args.words, args.max_length)
+    elif args.benchmark == "db-load":
+        benchmark_database_load(args.workers, args.users, args.stories)
+    elif args.benchmark == "password-hash":
+        benchmark_password_hash(args.budget_ms, args.logins)
+    elif args.benchmark == "email-outbox":
+        benchmark_email_outbox(args.messages, args.reply_delay)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,203 @@
+import asyncio
+import logging
+import queue
+import threading
+from contextlib import asynccontextmanager
+
+import aiohttp
+import httpx
+from openai import AsyncOpenAI
+
+from config import get_setting, get_settings
+
+# Process-wide registry of provider connection pools.
+#
+# Every outbound call (story generation, edits, image generation and downloads)
+# runs on one long-lived background event loop, so keep-alive connections and
+# TLS sessions are reused across requests instead of being rebuilt per call.
+PROVIDERS = {
+    "openai": {
+        "api_key_secret": "OPENAI_API_KEY",
+        "base_url": None,
+        "max_concurrency": 8,
+    },
+    "groq": {
+        "api_key_secret": "GROQ_API_KEY",
+        "base_url": "https://api.groq.com/openai/v1",
+        "max_concurrency": 8,
+    },
+    "sambanova": {
+        "api_key_secret": "SAMBANOVA_API_KEY",
+        "base_url": "https://api.sambanova.ai/v1",
+        "max_concurrency": 4,
+    },
+    "download": {
+        "api_key_secret": None,
+        "base_url": None,
+        "max_concurrency": 8,
+    },
+}
+
+# The timeout bounds each wait for data, not the whole request, so a long
+# but steadily streaming response is never cut off
+DEFAULT_TIMEOUT_SECONDS = 60
+DEFAULT_CONNECT_TIMEOUT_SECONDS = 10
+KEEPALIVE_EXPIRY_SECONDS = 60
+
+_loop = None
+_loop_lock = threading.Lock()
+
+# These are only touched from the background loop thread, so they need no lock.
+_http_sessions = {}
+_async_openai_clients = {}
+_semaphores = {}
+
+def get_provider_config(provider):
+    """
+    Return the effective configuration for a provider, with overrides from secrets.
+
+    Args:
+    provider (str): The provider name, e.g. "openai", "groq" or "sambanova".
+
+    Returns:
+    dict: The provider configuration including timeouts and concurrency limit.
+    """
+    config = dict(PROVIDERS[provider])
+    prefix = provider.upper()
+    config["max_concurrency"] = int(get_setting(f"{prefix}_MAX_CONCURRENCY", config["max_concurrency"]))
+    config["timeout"] = float(get_setting(f"{prefix}_TIMEOUT_SECONDS", get_setting("LLM_TIMEOUT_SECONDS", DEFAULT_TIMEOUT_SECONDS)))
+    config["connect_timeout"] = float(get_setting("LLM_CONNECT_TIMEOUT_SECONDS", DEFAULT_CONNECT_TIMEOUT_SECONDS))
+    return config
+
+def _api_key(config):
+    return get_settings()[config["api_key_secret"]] if config["api_key_secret"] else None
+
+def get_event_loop():
+    """
+    Return the background event loop that owns all pooled provider clients,
+    starting it on first use.
+    """
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            thread = threading.Thread(target=_loop.run_forever, name="storify-io-loop", daemon=True)
+            thread.start()
+            logging.info("Started background I/O event loop")
+        return _loop
+
+def run_async(coro, timeout=None):
+    """
+    Run a coroutine on the background loop and block until it finishes.
+
+    Args:
+    coro (coroutine): The coroutine to run.
+    timeout (float): Optional maximum number of seconds to wait.
+
+    Returns:
+    The coroutine's result.
+    """
+    return asyncio.run_coroutine_threadsafe(coro, get_event_loop()).result(timeout)
+
+def submit_async(coro):
+    """
+    Schedule a coroutine on the background loop without waiting for it.
+
+    Returns:
+    concurrent.futures.Future: The coroutine's eventual result.
+    """
+    return asyncio.run_coroutine_threadsafe(coro, get_event_loop())
+
+def iterate_async(agen):
+    """
+    Consume an async generator on the background loop and yield its items synchronously.
+    The generator runs inside a single task, so context managers spanning yields are safe.
+    """
+    items = queue.Queue()
+    done = object()
+
+    async def pump():
+        try:
+            async for item in agen:
+                items.put((item, None))
+        except Exception as e:
+            items.put((done, e))
+        else:
+            items.put((done, None))
+
+    future = asyncio.run_coroutine_threadsafe(pump(), get_event_loop())
+    try:
+        while True:
+            item, error = items.get()
+            if item is done:
+                if error is not None:
+                    raise error
+                return
+            yield item
+    finally:
+        future.cancel()
+
+def get_http_session(provider):
+    """
+    Return the pooled aiohttp session for a provider. Must be called on the background loop.
+    """
+    session = _http_sessions.get(provider)
+    if session is None or session.closed:
+        config = get_provider_config(provider)
+        headers = {}
+        api_key = _api_key(config)
+        if api_key:
+            headers["Authorization"] = f"Bearer {api_key}"
+        connector = aiohttp.TCPConnector(
+            limit=config["max_concurrency"],
+            keepalive_timeout=KEEPALIVE_EXPIRY_SECONDS,
+            ttl_dns_cache=300,
+        )
+        session = aiohttp.ClientSession(
+            connector=connector,
+            headers=headers,
+            # No total timeout: SSE streams can legitimately run longer than any fixed limit
+            timeout=aiohttp.ClientTimeout(total=None, sock_connect=config["connect_timeout"], sock_read=config["timeout"]),
+        )
+        _http_sessions[provider] = session
+        logging.info(f"Created pooled HTTP session for provider: {provider}")
+    return session
+
+def get_async_openai_client(provider):
+    """
+    Return the pooled AsyncOpenAI client for an OpenAI-compatible provider.
+    Must be called on the background loop.
+    """
+    client = _async_openai_clients.get(provider)
+    if client is None:
+        config = get_provider_config(provider)
+        timeout = httpx.Timeout(config["timeout"], connect=config["connect_timeout"])
+        http_client = httpx.AsyncClient(
+            timeout=timeout,
+            limits=httpx.Limits(
+                max_connections=config["max_concurrency"],
+                max_keepalive_connections=config["max_concurrency"],
+                keepalive_expiry=KEEPALIVE_EXPIRY_SECONDS,
+            ),
+        )
+        client = AsyncOpenAI(
+            api_key=_api_key(config),
+            base_url=config["base_url"],
+            timeout=timeout,
+            http_client=http_client,
+        )
+        _async_openai_clients[provider] = client
+        logging.info(f"Created pooled OpenAI client for provider: {provider}")
+    return client
+
+@asynccontextmanager
+async def provider_slot(provider):
+    """
+    Limit the number of concurrent in-flight requests to a provider.
+    """
+    semaphore = _semaphores.get(provider)
+    if semaphore is None:
+        semaphore = asyncio.Semaphore(get_provider_config(provider)["max_concurrency"])
+        _semaphores[provider] = semaphore
+    async with semaphore:
+        yield
@@ -0,0 +1,80 @@
+import logging
+import os
+import threading
+import tomllib
+
+# Settings are read once, on first use, from (in order of precedence):
+#   1. environment variables,
+#   2. Streamlit secrets (st.secrets), when the app runs under Streamlit,
+#   3. .streamlit/secrets.toml next to this file, so scripts, benchmarks and
+#      tests work from any working directory.
+# Importing this module does no I/O and does not import Streamlit.
+SECRETS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".streamlit", "secrets.toml")
+
+TRUE_VALUES = {"1", "true", "yes", "on"}
+
+class Settings:
+    """
+    Read-only access to configuration values. Values from environment
+    variables are strings; callers convert them like they do secrets.
+    """
+
+    def __init__(self, values):
+        self._values = dict(values)
+
+    def get(self, key, default=None):
+        if key in os.environ:
+            return os.environ[key]
+        return self._values.get(key, default)
+
+    def get_bool(self, key, default=False):
+        value = self.get(key, default)
+        if isinstance(value, str):
+            return value.strip().lower() in TRUE_VALUES
+        return bool(value)
+
+    def __getitem__(self, key):
+        value = self.get(key)
+        if value is None:
+            raise KeyError(f"Missing setting {key!r}: add it to {SECRETS_PATH} or the environment")
+        return value
+
+    def __contains__(self, key):
+        return key in os.environ or key in self._values
+
+def _load_streamlit_secrets():
+    import streamlit as st
+
+    try:
+        return st.secrets.to_dict()
+    except Exception:
+        # No secrets file where Streamlit looks for one
+        return {}
+
+def _load_settings():
+    values = {}
+    if os.path.exists(SECRETS_PATH):
+        with open(SECRETS_PATH, "rb") as f:
+            values.update(tomllib.load(f))
+    values.update(_load_streamlit_secrets())
+    logging.info(f"Loaded {len(values)} settings")
+    return Settings(values)
+
+_settings = None
+_settings_lock = threading.Lock()
+
+def get_settings():
+    """
+    Return the process-wide Settings, loading them on first use.
+    """
+    global _settings
+    with _settings_lock:
+        if _settings is None:
+            _settings = _load_settings()
+        return _settings
+
+def get_setting(key, default=None):
+    """
+    Read an optional setting, falling back to a default.
+    """
+    return get_settings().get(key, default)
@@ -1,129 +1,332 @@
 import sqlite3
-import streamlit as st
 import os
+import json
 import logging
+import hashlib
+import queue
+import time
+import uuid
+from itertools import groupby
 from contextlib import contextmanager
-from threading import Lock, get_ident  # Add this import
+from threading import Lock
 import threading
 # Database file name
 DB_NAME = 'storify_users.db'
 
-# Connection pool
-connection_pool = {}
-connection_pool_lock = Lock()
+# Connection tuning. WAL lets readers run alongside the writer, and with WAL
+# synchronous=NORMAL is still corruption-safe (only the last commits can be
+# lost on power failure) while avoiding an fsync per transaction.
+BUSY_TIMEOUT_MS = 5000
+CACHE_SIZE_KIB = 16 * 1024
+MMAP_SIZE = 256 * 1024 * 1024
 
-@st.cache_resource
-def get_database_connection():
-    thread_id = get_ident()
-    with connection_pool_lock:
-        if thread_id not in connection_pool:
+# SQLite serializes writers, so one writer connection per process is enough:
+# threads wait on the pool rather than in SQLite's sleep-and-retry busy handler.
+WRITER_POOL_SIZE = 1
+READER_POOL_SIZE = 8
+
+# Prepared statements kept per connection. Queries are constant strings with
+# bound parameters, so each one is compiled once per connection and reused.
+STATEMENT_CACHE_SIZE = 256
+
+# Story writes are buffered and flushed in one transaction per script run
+STORY_WRITE_BATCH_SIZE = 50
+story_write_buffer = []
+story_write_lock = Lock()
+# Held for a whole flush so concurrent flushes commit in queue order
+story_flush_lock = Lock()
+
+class ConnectionPool:
+    """
+    A bounded pool of tuned SQLite connections.
+
+    A thread that already holds a connection from the pool gets the same one
+    back, so nested `get_cursor` calls share a transaction instead of deadlocking.
+    """
+
+    def __init__(self, path, size, read_only=False):
+        self.path = path
+        self.size = size
+        self.read_only = read_only
+        self._idle = queue.LifoQueue()
+        self._created = 0
+        self._lock = Lock()
+        self._local = threading.local()
+
+    def _connect(self):
+        if self.read_only:
+            conn = sqlite3.connect(f"file:{self.path}?mode=ro", uri=True, check_same_thread=False, isolation_level=None, cached_statements=STATEMENT_CACHE_SIZE)
+        else:
+            conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None, cached_statements=STATEMENT_CACHE_SIZE)
+            conn.execute("PRAGMA journal_mode = WAL")
+        conn.execute(f"PRAGMA busy_timeout = {BUSY_TIMEOUT_MS}")
+        conn.execute("PRAGMA synchronous = NORMAL")
+        conn.execute(f"PRAGMA cache_size = -{CACHE_SIZE_KIB}")
+        conn.execute(f"PRAGMA mmap_size = {MMAP_SIZE}")
+        logging.info(f"Opened {'read-only' if self.read_only else 'read-write'} connection to {self.path}")
+        return conn
+
+    def _checkout(self):
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            can_create = self._created < self.size
+            if can_create:
+                self._created += 1
+        if not can_create:
+            return self._idle.get()
+        try:
+            return self._connect()
+        except sqlite3.Error:
+            with self._lock:
+                self._created -= 1
+            raise
+
+    def held(self):
+        """Return the connection the current thread holds, if any."""
+        return getattr(self._local, "connection", None)
+
+    @contextmanager
+    def connection(self):
+        held = self.held()
+        if held is not None:
+            yield held
+            return
+        conn = self._checkout()
+        self._local.connection = conn
+        try:
+            yield conn
+        finally:
+            self._local.connection = None
+            self._idle.put(conn)
+
+    def close(self):
+        while True:
             try:
-                conn = sqlite3.connect(DB_NAME, check_same_thread=False)
-                logging.info(f"Successfully connected to database: {DB_NAME}")
-                create_tables_if_not_exist(conn)
-                connection_pool[thread_id] = conn
-            except sqlite3.Error as e:
-                logging.error(f"Error connecting to database: {str(e)}")
-                raise
-        return connection_pool[thread_id]
-
-def close_database_connection():
-    thread_id = threading.get_ident()
-    with connection_pool_lock:
-        if thread_id in connection_pool:
-            connection_pool[thread_id].close()
-            del connection_pool[thread_id]
-
-def create_tables_if_not_exist(conn):
-    cursor = conn.cursor()
-    try:
-        cursor.execute('''
-        CREATE TABLE IF NOT EXISTS users (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            email TEXT UNIQUE,
-            password TEXT,
-            confirmation_token TEXT,
-            is_confirmed INTEGER DEFAULT 0,
-            reset_token TEXT
-        )
-        ''')
-        conn.commit()
-        logging.info("Users table created or already exists")
-    except sqlite3.Error as e:
-        logging.error(f"Error creating users table: {str(e)}")
-        raise
-    finally:
-        cursor.close()
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                break
+        with self._lock:
+            self._created = 0
+
+_writer_pool = None
+_reader_pool = None
+_pool_lock = Lock()
+_schema_ready = False
+_schema_lock = Lock()
+
+def _get_writer_pool():
+    global _writer_pool
+    with _pool_lock:
+        if _writer_pool is None:
+            _writer_pool = ConnectionPool(DB_NAME, WRITER_POOL_SIZE)
+        pool = _writer_pool
+    if not _schema_ready:
+        migrate_database(pool)
+    return pool
+
+def _get_reader_pool():
+    global _reader_pool
+    # Read-only connections need the database (and its WAL files) to exist
+    _get_writer_pool()
+    with _pool_lock:
+        if _reader_pool is None:
+            _reader_pool = ConnectionPool(DB_NAME, READER_POOL_SIZE, read_only=True)
+        return _reader_pool
+
+def configure_database(path):
+    """
+    Point the connection pools at another database file, e.g. for benchmarks.
+    """
+    global DB_NAME, _schema_ready
+    close_database_connections()
+    DB_NAME = path
+    _schema_ready = False
+
+def close_database_connections():
+    global _writer_pool, _reader_pool
+    with _pool_lock:
+        for pool in (_reader_pool, _writer_pool):
+            if pool is not None:
+                pool.close()
+        _writer_pool = None
+        _reader_pool = None
+
+USERS_COLUMNS = ["id", "username", "email", "password", "reset_token", "confirmation_token", "is_confirmed", "created_at"]
+
+CREATE_USERS_SQL = '''
+CREATE TABLE {table} (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    username TEXT UNIQUE,
+    email TEXT UNIQUE,
+    password TEXT NOT NULL,
+    reset_token TEXT,
+    confirmation_token TEXT,
+    is_confirmed INTEGER DEFAULT 0,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+)
+'''
+
+def _migration_baseline(cursor):
+    """
+    Bring a database created by any earlier version to one schema. Older
+    versions created `users` with two different column layouts, and auth
+    reads user rows by position, so a table with another layout is rebuilt.
+    """
+    cursor.execute("PRAGMA table_info(users)")
+    columns = [column[1] for column in cursor.fetchall()]
+    if not columns:
+        cursor.execute(CREATE_USERS_SQL.format(table="users"))
+    elif columns != USERS_COLUMNS:
+        shared = [column for column in USERS_COLUMNS if column in columns]
+        selected = ["COALESCE(password, '')" if column == "password" else column for column in shared]
+        cursor.execute(CREATE_USERS_SQL.format(table="users_migrated"))
+        cursor.execute(f"INSERT INTO users_migrated ({', '.join(shared)}) SELECT {', '.join(selected)} FROM users")
+        cursor.execute("DROP TABLE users")
+        cursor.execute("ALTER TABLE users_migrated RENAME TO users")
+
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS stories (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER,
+        title TEXT NOT NULL,
+        content TEXT NOT NULL,
+        genre TEXT,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        uid TEXT,
+        prompt TEXT,
+        parent_uid TEXT,
+        media TEXT,
+        FOREIGN KEY (user_id) REFERENCES users (id)
+    )
+    ''')
+    # Columns used to persist chat stories and their media references
+    cursor.execute("PRAGMA table_info(stories)")
+    story_columns = {column[1] for column in cursor.fetchall()}
+    for column in ("uid", "prompt", "parent_uid", "media"):
+        if column not in story_columns:
+            cursor.execute(f"ALTER TABLE stories ADD COLUMN {column} TEXT")
+    cursor.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_stories_uid ON stories (uid)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_stories_user_id_created_at ON stories (user_id, created_at)")
+
+def _migration_tokens(cursor):
+    """
+    Move confirmation and reset tokens out of plaintext users columns into a
+    tokens table keyed by the token's SHA-256, with a purpose and an expiry.
+    Tokens are looked up by that key and users.email is indexed by its UNIQUE
+    constraint, so the token columns on users need no indexes.
+    """
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS tokens (
+        token_hash TEXT PRIMARY KEY,
+        user_id INTEGER NOT NULL,
+        purpose TEXT NOT NULL,
+        created_at INTEGER NOT NULL,
+        expires_at INTEGER NOT NULL,
+        used_at INTEGER,
+        FOREIGN KEY (user_id) REFERENCES users (id)
+    ) WITHOUT ROWID
+    ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_tokens_expires_at ON tokens (expires_at)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_tokens_user_id_purpose ON tokens (user_id, purpose)")
+
+    # Outstanding tokens get a fresh expiry, the same as newly issued ones
+    now = int(time.time())
+    cursor.execute("SELECT id, confirmation_token, reset_token FROM users WHERE confirmation_token IS NOT NULL OR reset_token IS NOT NULL")
+    migrated = []
+    for user_id, confirmation_token, reset_token in cursor.fetchall():
+        for token, purpose, ttl in ((confirmation_token, "confirmation", 24 * 3600), (reset_token, "reset", 3600)):
+            if token:
+                migrated.append((hashlib.sha256(token.encode()).hexdigest(), user_id, purpose, now, now + ttl))
+    cursor.executemany("INSERT OR IGNORE INTO tokens (token_hash, user_id, purpose, created_at, expires_at) VALUES (?, ?, ?, ?, ?)", migrated)
+    cursor.execute("UPDATE users SET confirmation_token = NULL, reset_token = NULL WHERE confirmation_token IS NOT NULL OR reset_token IS NOT NULL")
+
+# Schema migrations in order; migration N brings PRAGMA user_version to N.
+# Never edit or reorder released migrations, only append new ones.
+MIGRATIONS = [
+    _migration_baseline,
+    _migration_tokens,
+]
+SCHEMA_VERSION = len(MIGRATIONS)
+
+def migrate_database(pool):
+    """
+    Apply pending migrations once per process, on first use of the database.
+
+    A current schema costs one PRAGMA user_version read. Pending migrations run
+    in a single BEGIN IMMEDIATE transaction, which also serializes them against
+    other processes migrating the same file.
+    """
+    global _schema_ready
+    with _schema_lock:
+        if _schema_ready:
+            return
+        with pool.connection() as conn:
+            version = conn.execute("PRAGMA user_version").fetchone()[0]
+            if version < SCHEMA_VERSION:
+                conn.execute("BEGIN IMMEDIATE")
+                try:
+                    # Another process may have migrated while we waited for the write lock
+                    version = conn.execute("PRAGMA user_version").fetchone()[0]
+                    cursor = conn.cursor()
+                    for number, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+                        logging.info(f"Applying database migration {number}: {migration.__name__}")
+                        migration(cursor)
+                        cursor.execute(f"PRAGMA user_version = {number}")
+                    conn.commit()
+                except Exception:
+                    conn.rollback()
+                    raise
+            elif version > SCHEMA_VERSION:
+                logging.warning(f"Database schema version {version} is newer than this code ({SCHEMA_VERSION})")
+        _schema_ready = True
 
 @contextmanager
 def get_cursor():
-    conn = get_database_connection()
-    cursor = conn.cursor()
-    try:
-        yield cursor
-        conn.commit()
-    except Exception as e:
-        conn.rollback()
-        raise e
-    finally:
-        cursor.close()
-
-def init_db():
-    with get_cursor() as cursor:
-        cursor.execute('''
-        CREATE TABLE IF NOT EXISTS users (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            username TEXT UNIQUE,
-            email TEXT UNIQUE,
-            password TEXT NOT NULL,
-            reset_token TEXT,
-            confirmation_token TEXT,
-            is_confirmed INTEGER DEFAULT 0,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
-        ''')
-        
-        cursor.execute('''
-        CREATE TABLE IF NOT EXISTS stories (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER,
-            title TEXT NOT NULL,
-            content TEXT NOT NULL,
-            genre TEXT,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (user_id) REFERENCES users (id)
-        )
-        ''')
-
-def migrate_database():
-    with get_cursor() as cursor:
-        # Check existing columns
-        cursor.execute("PRAGMA table_info(users)")
-        columns = {column[1] for column in cursor.fetchall()}
-        
-        # If the table is empty or doesn't have the expected structure, recreate it
-        if not columns or 'id' not in columns:
-            cursor.execute("DROP TABLE IF EXISTS users")
-            cursor.execute('''
-            CREATE TABLE users (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                username TEXT UNIQUE,
-                email TEXT UNIQUE,
-                password TEXT NOT NULL,
-                reset_token TEXT,
-                confirmation_token TEXT,
-                is_confirmed INTEGER DEFAULT 0,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-            ''')
-        else:
-            # Add missing columns if necessary
-            if 'email' not in columns:
-                cursor.execute("ALTER TABLE users ADD COLUMN email TEXT UNIQUE")
-            if 'confirmation_token' not in columns:
-                cursor.execute("ALTER TABLE users ADD COLUMN confirmation_token TEXT")
-            if 'is_confirmed' not in columns:
-                cursor.execute("ALTER TABLE users ADD COLUMN is_confirmed INTEGER DEFAULT 0")
+    """
+    Yield a cursor on the writer connection inside a transaction that is
+    committed on success and rolled back on error. BEGIN IMMEDIATE takes the
+    write lock up front, so a transaction that reads before writing waits
+    on busy_timeout instead of failing with "database is locked".
+    """
+    with _get_writer_pool().connection() as conn:
+        outermost = not conn.in_transaction
+        if outermost:
+            conn.execute("BEGIN IMMEDIATE")
+        cursor = conn.cursor()
+        try:
+            yield cursor
+            if outermost:
+                conn.commit()
+        except Exception as e:
+            if outermost:
+                conn.rollback()
+            raise e
+        finally:
+            cursor.close()
+
+@contextmanager
+def get_read_cursor():
+    """
+    Yield a cursor on a read-only connection. Inside a `get_cursor` block the
+    writer connection is used instead, so the thread sees its own uncommitted writes.
+    """
+    writer = _get_writer_pool().held()
+    if writer is not None:
+        cursor = writer.cursor()
+        try:
+            yield cursor
+        finally:
+            cursor.close()
+        return
+    with _get_reader_pool().connection() as conn:
+        cursor = conn.cursor()
+        try:
+            yield cursor
+        finally:
+            cursor.close()
 
 def add_user(email, password):
     with get_cursor() as cursor:
@@ -134,25 +337,103 @@ def add_user(email, password):
             return False
 
 def get_user(email):
-    with get_cursor() as cursor:
+    with get_read_cursor() as cursor:
         cursor.execute("SELECT * FROM users WHERE email = ?", (email,))
         return cursor.fetchone()
 
-def save_story(user_id, title, content, genre):
+INSERT_STORY_SQL = """
+INSERT INTO stories (uid, user_id, title, content, genre, prompt, parent_uid, media)
+VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+"""
+
+def _story_params(user_id, title, content, genre, prompt, parent_uid, media):
+    return (uuid.uuid4().hex, user_id, title, content, genre, prompt, parent_uid, json.dumps(media or {}))
+
+def save_story(user_id, title, content, genre, prompt=None, parent_uid=None, media=None):
     with get_cursor() as cursor:
-        cursor.execute("""
-        INSERT INTO stories (user_id, title, content, genre)
-        VALUES (?, ?, ?, ?)
-        """, (user_id, title, content, genre))
+        cursor.execute(INSERT_STORY_SQL, _story_params(user_id, title, content, genre, prompt, parent_uid, media))
         return cursor.lastrowid
 
-def get_user_stories(user_id):
-    with get_cursor() as cursor:
-        cursor.execute("SELECT * FROM stories WHERE user_id = ? ORDER BY created_at DESC", (user_id,))
+def get_user_stories(user_id, limit=None, before=None):
+    """
+    Return a user's stories, newest first, one page at a time.
+
+    Pages are keyset-paginated on the (user_id, created_at) index: pass the
+    (created_at, id) of the oldest story already loaded as `before` to get the
+    next page, which stays correct while new stories are being added.
+    """
+    with get_read_cursor() as cursor:
+        if before is None:
+            cursor.execute("""
+            SELECT id, uid, title, content, genre, prompt, parent_uid, media, created_at
+            FROM stories
+            WHERE user_id = ?
+            ORDER BY created_at DESC, id DESC
+            LIMIT ?
+            """, (user_id, -1 if limit is None else limit))
+        else:
+            cursor.execute("""
+            SELECT id, uid, title, content, genre, prompt, parent_uid, media, created_at
+            FROM stories
+            WHERE user_id = ? AND (created_at, id) < (?, ?)
+            ORDER BY created_at DESC, id DESC
+            LIMIT ?
+            """, (user_id, *before, -1 if limit is None else limit))
         return cursor.fetchall()
 
+def get_user_id(email):
+    with get_read_cursor() as cursor:
+        cursor.execute("SELECT id FROM users WHERE email = ?", (email,))
+        row = cursor.fetchone()
+        return row[0] if row else None
+
+def queue_story(user_id, title, content, genre, prompt=None, parent_uid=None, media=None):
+    """
+    Like save_story, but queued for the next batched write. Returns the story's
+    uid, which can be used to attach media before the story has been flushed.
+    """
+    params = _story_params(user_id, title, content, genre, prompt, parent_uid, media)
+    _queue_story_write(INSERT_STORY_SQL, params)
+    return params[0]
+
+def queue_story_media_update(uid, media):
+    """
+    Queue merging media references (e.g. {"audio_ref": ...}) into a story's media column.
+    """
+    _queue_story_write(
+        "UPDATE stories SET media = json_patch(COALESCE(media, '{}'), ?) WHERE uid = ?",
+        (json.dumps(media), uid),
+    )
+
+def _queue_story_write(sql, params):
+    with story_write_lock:
+        story_write_buffer.append((sql, params))
+        should_flush = len(story_write_buffer) >= STORY_WRITE_BATCH_SIZE
+    if should_flush:
+        flush_story_writes()
+
+def flush_story_writes():
+    """
+    Write all queued story inserts and updates in one transaction.
+    """
+    with story_flush_lock:
+        with story_write_lock:
+            writes = story_write_buffer[:]
+            story_write_buffer.clear()
+        if not writes:
+            return
+        try:
+            with get_cursor() as cursor:
+                for sql, group in groupby(writes, key=lambda write: write[0]):
+                    cursor.executemany(sql, [params for _, params in group])
+            logging.info(f"Flushed {len(writes)} story writes")
+        except sqlite3.Error as e:
+            logging.error(f"Error flushing story writes: {str(e)}")
+            with story_write_lock:
+                story_write_buffer[:0] = writes
+
 def get_story(story_id):
-    with get_cursor() as cursor:
+    with get_read_cursor() as cursor:
         cursor.execute("SELECT * FROM stories WHERE id = ?", (story_id,))
         return cursor.fetchone()
 
@@ -169,7 +450,3 @@ def delete_story(story_id):
     with get_cursor() as cursor:
         cursor.execute("DELETE FROM stories WHERE id = ?", (story_id,))
         return cursor.rowcount > 0
-
-# Initialize the database and perform migrations
-init_db()
-migrate_database()
\ No newline at end of file
@@ -1,48 +1,183 @@
-import smtplib
+import asyncio
+import threading
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
-import toml
 import logging
 
-# Load secrets from secrets.toml
-secrets = toml.load('.streamlit/secrets.toml')
+from config import get_settings
 
-def send_email(to_email, subject, body):
+# aiosmtplib and tenacity are only imported by the outbox worker, so
+# importing this module (e.g. from the auth UI) stays cheap.
+
+# Messages are queued and delivered by a background worker, which keeps one
+# authenticated SMTP connection open while there is mail to send
+BATCH_SIZE = 20
+IDLE_TIMEOUT_SECONDS = 60
+MAX_ATTEMPTS = 5
+RETRY_MAX_WAIT_SECONDS = 30
+
+def _is_transient(error):
+    import aiosmtplib
+
+    # 5xx replies (unknown recipient, bad credentials, ...) fail the same way on retry
+    if isinstance(error, aiosmtplib.SMTPResponseException) and error.code >= 500:
+        return False
+    if isinstance(error, aiosmtplib.SMTPRecipientsRefused):
+        return False
+    return isinstance(error, (aiosmtplib.SMTPException, OSError, asyncio.TimeoutError))
+
+class EmailOutbox:
     """
-    Send an email using SMTP.
+    Queue outgoing email and deliver it from a background thread with its own
+    event loop, so sending never blocks the Streamlit script thread.
+
+    Queued messages are sent in batches over one warm SMTP connection, which is
+    closed after `idle_timeout` seconds without mail. Transient failures
+    reconnect and retry with exponential backoff.
     """
-    # Use secrets for email configuration
-    smtp_server = secrets['SMTP_SERVER']
-    smtp_port = secrets['SMTP_PORT']
-    smtp_username = secrets['SMTP_USERNAME']
-    smtp_password = secrets['SMTP_PASSWORD']
-    from_email = secrets['FROM_EMAIL']
 
+    def __init__(self, settings, batch_size=BATCH_SIZE, idle_timeout=IDLE_TIMEOUT_SECONDS, max_attempts=MAX_ATTEMPTS):
+        self.settings = settings
+        self.batch_size = batch_size
+        self.idle_timeout = idle_timeout
+        self.max_attempts = max_attempts
+        self.sent = 0
+        self.failed = 0
+        self.connections = 0
+        self._smtp = None
+        self._loop = None
+        self._queue = None
+        self._lock = threading.Lock()
+        self._idle = threading.Condition(self._lock)
+        self._unfinished = 0
+
+    def _start(self):
+        # Called with self._lock held
+        if self._loop is None:
+            self._loop = asyncio.new_event_loop()
+            self._queue = asyncio.Queue()
+            threading.Thread(target=self._run, name="storify-email-outbox", daemon=True).start()
+
+    def _run(self):
+        asyncio.set_event_loop(self._loop)
+        self._loop.run_until_complete(self._worker())
+
+    def send(self, message):
+        """
+        Queue a message for delivery and return immediately.
+        """
+        with self._lock:
+            self._start()
+            self._unfinished += 1
+        self._loop.call_soon_threadsafe(self._queue.put_nowait, message)
+
+    def wait_until_sent(self, timeout=None):
+        """
+        Block until every queued message has been delivered or has failed.
+
+        Returns:
+        bool: False if the timeout expired first.
+        """
+        with self._idle:
+            return self._idle.wait_for(lambda: self._unfinished == 0, timeout)
+
+    async def _worker(self):
+        while True:
+            try:
+                message = await asyncio.wait_for(self._queue.get(), self.idle_timeout)
+            except asyncio.TimeoutError:
+                await self._disconnect()
+                continue
+            batch = [message]
+            while len(batch) < self.batch_size and not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+            for message in batch:
+                await self._deliver(message)
+            with self._idle:
+                self._unfinished -= len(batch)
+                self._idle.notify_all()
+
+    async def _connect(self):
+        import aiosmtplib
+
+        if self._smtp is not None and self._smtp.is_connected:
+            return self._smtp
+        settings = self.settings
+        use_tls = settings.get_bool('SMTP_USE_TLS', False)
+        smtp = aiosmtplib.SMTP(
+            hostname=settings['SMTP_SERVER'],
+            port=int(settings['SMTP_PORT']),
+            use_tls=use_tls,
+            start_tls=False if use_tls else settings.get_bool('SMTP_STARTTLS', True),
+            timeout=float(settings.get('SMTP_TIMEOUT_SECONDS', 30)),
+        )
+        logging.info(f"Connecting to SMTP server: {settings['SMTP_SERVER']}:{settings['SMTP_PORT']}")
+        await smtp.connect()
+        if settings.get('SMTP_USERNAME'):
+            await smtp.login(settings['SMTP_USERNAME'], settings['SMTP_PASSWORD'])
+        self._smtp = smtp
+        self.connections += 1
+        return smtp
+
+    async def _disconnect(self):
+        import aiosmtplib
+
+        smtp, self._smtp = self._smtp, None
+        if smtp is not None and smtp.is_connected:
+            try:
+                await smtp.quit()
+            except aiosmtplib.SMTPException:
+                smtp.close()
+
+    async def _deliver(self, message):
+        from tenacity import AsyncRetrying, retry_if_exception, stop_after_attempt, wait_exponential
+
+        try:
+            async for attempt in AsyncRetrying(
+                stop=stop_after_attempt(self.max_attempts),
+                wait=wait_exponential(multiplier=0.5, max=RETRY_MAX_WAIT_SECONDS),
+                retry=retry_if_exception(_is_transient),
+                reraise=True,
+            ):
+                with attempt:
+                    try:
+                        smtp = await self._connect()
+                        await smtp.send_message(message)
+                    except Exception:
+                        # Start the next attempt on a fresh connection
+                        await self._disconnect()
+                        raise
+            self.sent += 1
+            logging.info(f"Email sent successfully to {message['To']}")
+        except Exception as e:
+            self.failed += 1
+            logging.error(f"Giving up on email to {message['To']}: {str(e)}")
+
+_outbox = None
+_outbox_lock = threading.Lock()
+
+def get_email_outbox():
+    global _outbox
+    with _outbox_lock:
+        if _outbox is None:
+            _outbox = EmailOutbox(get_settings())
+        return _outbox
+
+def build_message(from_email, to_email, subject, body):
     message = MIMEMultipart()
     message['From'] = from_email
     message['To'] = to_email
     message['Subject'] = subject
 
     message.attach(MIMEText(body, 'plain'))
+    return message
 
-    try:
-        logging.info(f"Attempting to connect to SMTP server: {smtp_server}:{smtp_port}")
-        with smtplib.SMTP(smtp_server, smtp_port) as server:
-            logging.info("SMTP connection established")
-            server.ehlo()
-            server.starttls()
-            server.ehlo()
-            logging.info(f"Attempting to login with username: {smtp_username}")
-            server.login(smtp_username, smtp_password)
-            logging.info("SMTP login successful")
-            server.send_message(message)
-            logging.info(f"Email sent successfully to {to_email}")
-    except smtplib.SMTPException as e:
-        logging.error(f"SMTP error occurred: {str(e)}")
-        raise
-    except Exception as e:
-        logging.error(f"Unexpected error in send_email: {str(e)}")
-        raise
+def send_email(to_email, subject, body):
+    """
+    Queue an email for background delivery through the outbox. Delivery
+    failures are retried and then logged by the outbox worker, not raised here.
+    """
+    get_email_outbox().send(build_message(get_settings()['FROM_EMAIL'], to_email, subject, body))
 
 def send_confirmation_email(to_email, confirmation_token):
     """
@@ -0,0 +1,146 @@
+import hashlib
+import re
+import threading
+from collections import OrderedDict
+
+# Token budget for prior conversation turns, per text model. The system message,
+# the new prompt and the completion are budgeted separately.
+HISTORY_TOKEN_BUDGETS = {
+    "gpt-4-1106-preview": 6000,
+    "gpt-3.5-turbo": 2500,
+    "llama-3.1-70b-versatile": 4000,
+    "Meta-Llama-3.1-405B-Instruct": 4000,
+}
+DEFAULT_HISTORY_TOKEN_BUDGET = 2500
+
+# Share of the budget reserved for the rolling summary of older turns
+SUMMARY_BUDGET_SHARE = 0.25
+SUMMARY_SENTENCE_CHARS = 200
+MAX_CACHED_SUMMARIES = 256
+
+_summary_cache = OrderedDict()
+_summary_cache_lock = threading.Lock()
+
+def estimate_tokens(text):
+    """
+    Roughly estimate the number of tokens in a text (about 4 characters per token).
+    """
+    return len(text) // 4 + 1
+
+def strip_media(history):
+    """
+    Reduce chat messages to their role and text, dropping image/audio payloads and other keys.
+    """
+    return [{"role": m["role"], "content": m["content"]} for m in history]
+
+def _first_sentence(text):
+    match = re.match(r"\s*(.+?[.!?])(\s|$)", text, re.S)
+    sentence = " ".join((match.group(1) if match else text).split())
+    if len(sentence) > SUMMARY_SENTENCE_CHARS:
+        sentence = sentence[:SUMMARY_SENTENCE_CHARS - 3] + "..."
+    return sentence
+
+def extractive_summary(previous_summary, turns):
+    """
+    Extend a rolling summary with the opening sentence of each newly dropped turn.
+
+    Args:
+    previous_summary (str): The summary of the turns before `turns`, or "".
+    turns (list): The messages to fold into the summary.
+
+    Returns:
+    str: The extended summary.
+    """
+    labels = {"user": "User asked", "assistant": "Storyteller replied"}
+    parts = [previous_summary] if previous_summary else []
+    parts.extend(f"{labels.get(m['role'], m['role'])}: {_first_sentence(m['content'])}" for m in turns)
+    return " ".join(parts)
+
+def _truncate_to_budget(text, budget, keep_end=True):
+    max_chars = max(0, (budget - 1) * 4)
+    if len(text) <= max_chars:
+        return text
+    return "..." + text[-max_chars:] if keep_end else text[:max_chars] + "..."
+
+def _prefix_digests(turns):
+    """Running digests, so digests[i] identifies turns[:i + 1]."""
+    digests = []
+    running = hashlib.sha256()
+    for m in turns:
+        running.update(f"{m['role']}\x00{m['content']}\x01".encode())
+        digests.append(running.copy().hexdigest())
+    return digests
+
+def summarize_turns(turns, budget, summarizer=extractive_summary):
+    """
+    Summarize turns incrementally, reusing the cached summary of the longest already-summarized prefix.
+
+    Args:
+    turns (list): The older messages to summarize, oldest first.
+    budget (int): Maximum number of tokens for the summary.
+    summarizer (callable): Function of (previous_summary, new_turns) returning the extended summary.
+
+    Returns:
+    str: The rolling summary.
+    """
+    digests = _prefix_digests(turns)
+    summary, start = "", 0
+    with _summary_cache_lock:
+        for i in range(len(digests) - 1, -1, -1):
+            if digests[i] in _summary_cache:
+                summary, start = _summary_cache[digests[i]], i + 1
+                _summary_cache.move_to_end(digests[i])
+                break
+    if start < len(turns):
+        summary = _truncate_to_budget(summarizer(summary, turns[start:]), budget)
+        with _summary_cache_lock:
+            _summary_cache[digests[-1]] = summary
+            while len(_summary_cache) > MAX_CACHED_SUMMARIES:
+                _summary_cache.popitem(last=False)
+    return summary
+
+def compact_history(history, model, budget=None, summarizer=extractive_summary):
+    """
+    Fit the conversation history into the model's token budget.
+
+    Media payloads are stripped, the most recent turns are kept verbatim, and the
+    older turns are replaced by one rolling summary message, so the prompt size
+    stays bounded however long the session runs.
+
+    Args:
+    history (list): The prior chat messages, oldest first.
+    model (str): The text model id used to look up the budget.
+    budget (int): Optional override of the history token budget.
+    summarizer (callable): Function used to extend the rolling summary.
+
+    Returns:
+    list: Messages with only "role" and "content" keys.
+    """
+    messages = strip_media(history)
+    if budget is None:
+        budget = HISTORY_TOKEN_BUDGETS.get(model, DEFAULT_HISTORY_TOKEN_BUDGET)
+
+    total = sum(estimate_tokens(m["content"]) for m in messages)
+    if total <= budget:
+        return messages
+
+    summary_budget = int(budget * SUMMARY_BUDGET_SHARE)
+    recent_budget = budget - summary_budget
+    recent = []
+    used = 0
+    for m in reversed(messages):
+        tokens = estimate_tokens(m["content"])
+        if used + tokens > recent_budget:
+            if not recent:
+                # Always keep the latest turn, trimmed to fit
+                recent.append({"role": m["role"], "content": _truncate_to_budget(m["content"], recent_budget, keep_end=False)})
+            break
+        recent.append(m)
+        used += tokens
+    recent.reverse()
+
+    older = messages[:len(messages) - len(recent)]
+    if not older:
+        return recent
+    summary = summarize_turns(older, summary_budget, summarizer)
+    return [{"role": "system", "content": f"Summary of the earlier conversation: {summary}"}] + recent
@@ -1,13 +1,20 @@
-import openai
-import requests
+import asyncio
+import os
 from PIL import Image
 from io import BytesIO
 import streamlit as st
-from diffusers import StableDiffusionPipeline, DPMSolverMultistepScheduler
+from diffusers import (
+    StableDiffusionPipeline,
+    DPMSolverMultistepScheduler,
+    EulerAncestralDiscreteScheduler,
+    EulerDiscreteScheduler,
+    UniPCMultistepScheduler,
+)
 import torch
-from openai import OpenAI
-
-client = OpenAI(api_key=st.secrets["OPENAI_API_KEY"])
+from clients import get_async_openai_client, get_http_session, provider_slot, run_async
+from config import get_setting
+from singleflight import get_singleflight, make_flight_key
+from utils import split_sentences
 
 @st.cache_data(show_spinner=False)
 def generate_story_image_dalle(prompt, size="1024x1024"):
@@ -26,7 +33,14 @@ def generate_story_image_dalle(prompt, size="1024x1024"):
         if size not in ["1024x1024", "1792x1024", "1024x1792"]:
             size = "1024x1024"  # Default to 1024x1024 if an unsupported size is provided
         
-        response = client.images.generate(
+        return run_async(_generate_image_dalle_async(prompt, size))
+    except Exception as e:
+        st.error(f"An error occurred while generating the image: {str(e)}")
+        return None
+
+async def _generate_image_dalle_async(prompt, size):
+    async with provider_slot("openai"):
+        response = await get_async_openai_client("openai").images.generate(
             model="dall-e-3",
             prompt=prompt,
             size=size,
@@ -34,13 +48,12 @@ def generate_story_image_dalle(prompt, size="1024x1024"):
             n=1,
         )
 
-        image_url = response.data[0].url
-        image_response = requests.get(image_url)
-        image = Image.open(BytesIO(image_response.content))
-        return image
-    except Exception as e:
-        st.error(f"An error occurred while generating the image: {str(e)}")
-        return None
+    image_url = response.data[0].url
+    async with provider_slot("download"):
+        async with get_http_session("download").get(image_url) as image_response:
+            image_response.raise_for_status()
+            image_bytes = await image_response.read()
+    return Image.open(BytesIO(image_bytes))
 
 def preprocess_prompt(story_content, max_length=1000):
     """
@@ -54,8 +67,7 @@ def preprocess_prompt(story_content, max_length=1000):
     str: A preprocessed prompt suitable for image generation.
     """
     # Extract the first few sentences (adjust as needed)
-    sentences = story_content.split('.')[:3]
-    shortened_content = '. '.join(sentences)
+    shortened_content = ' '.join(split_sentences(story_content)[:3])
     
     # Create a prompt focusing on visual elements
     prompt = f"Create an image that captures the essence of this story: {shortened_content}"
@@ -66,13 +78,93 @@ def preprocess_prompt(story_content, max_length=1000):
     
     return prompt
 
+SCHEDULERS = {
+    "dpm++": DPMSolverMultistepScheduler,
+    "euler": EulerDiscreteScheduler,
+    "euler_a": EulerAncestralDiscreteScheduler,
+    "unipc": UniPCMultistepScheduler,
+}
+
+# Fast multistep schedulers give usable images in far fewer steps than the pipeline default of 50
+CPU_DEFAULT_STEPS = 20
+CPU_DTYPES = {"fp32": torch.float32, "bf16": torch.bfloat16}
+
+def get_stable_diffusion_settings():
+    """
+    Read the Stable Diffusion inference settings from secrets.
+
+    Returns:
+    dict: scheduler, cpu_dtype, num_inference_steps (None means the pipeline default) and num_threads.
+    """
+    on_gpu = torch.cuda.is_available()
+    steps = get_setting("SD_STEPS", None if on_gpu else CPU_DEFAULT_STEPS)
+    # Secrets and environment variables are strings, so "0" would otherwise pass a truthiness check
+    if steps is not None:
+        steps = int(steps)
+        if steps <= 0:
+            raise ValueError(f"SD_STEPS must be a positive number of steps, got {steps}")
+    return {
+        "scheduler": get_setting("SD_SCHEDULER", "dpm++"),
+        "cpu_dtype": get_setting("SD_CPU_DTYPE", "fp32"),
+        "num_inference_steps": steps,
+        "num_threads": int(get_setting("SD_CPU_THREADS", os.cpu_count() or 1)),
+    }
+
+def configure_cpu_threads(num_threads):
+    """
+    Set the torch intra-op (and, if still possible, inter-op) thread counts explicitly.
+    """
+    torch.set_num_threads(num_threads)
+    try:
+        torch.set_num_interop_threads(max(1, num_threads // 2))
+    except RuntimeError:
+        # Inter-op threads can only be set before the first parallel op runs
+        pass
+
 @st.cache_resource
-def load_stable_diffusion_model(model_id):
-    pipe = StableDiffusionPipeline.from_pretrained(model_id, torch_dtype=torch.float16)
-    pipe.scheduler = DPMSolverMultistepScheduler.from_config(pipe.scheduler.config)
-    pipe = pipe.to("cuda" if torch.cuda.is_available() else "cpu")
+def load_stable_diffusion_model(model_id, scheduler="dpm++", cpu_dtype="fp32", num_threads=None):
+    """
+    Load a Stable Diffusion pipeline tuned for the available hardware.
+
+    On CUDA the pipeline runs in fp16. On CPU-only hosts it loads in fp32 or bf16,
+    enables attention slicing and channels-last memory layout, and uses explicit
+    torch thread counts.
+
+    Args:
+    model_id (str): The Hugging Face model ID for the Stable Diffusion model.
+    scheduler (str): One of the SCHEDULERS keys.
+    cpu_dtype (str): "fp32" or "bf16"; only used on CPU.
+    num_threads (int): Torch thread count on CPU (defaults to all cores).
+
+    Returns:
+    StableDiffusionPipeline: The loaded pipeline.
+    """
+    scheduler_class = SCHEDULERS.get(scheduler, DPMSolverMultistepScheduler)
+    if torch.cuda.is_available():
+        pipe = StableDiffusionPipeline.from_pretrained(model_id, torch_dtype=torch.float16)
+        pipe.scheduler = scheduler_class.from_config(pipe.scheduler.config)
+        return pipe.to("cuda")
+
+    configure_cpu_threads(num_threads or os.cpu_count() or 1)
+    pipe = StableDiffusionPipeline.from_pretrained(model_id, torch_dtype=CPU_DTYPES.get(cpu_dtype, torch.float32))
+    pipe.scheduler = scheduler_class.from_config(pipe.scheduler.config)
+    pipe = pipe.to("cpu")
+    pipe.enable_attention_slicing()
+    pipe.unet.to(memory_format=torch.channels_last)
+    pipe.vae.to(memory_format=torch.channels_last)
+    pipe.set_progress_bar_config(disable=True)
     return pipe
 
+def _run_stable_diffusion(prompts, size, model_id):
+    """Render a list of prompts in one batched pipeline call."""
+    settings = get_stable_diffusion_settings()
+    pipe = load_stable_diffusion_model(model_id, settings["scheduler"], settings["cpu_dtype"], settings["num_threads"])
+    options = {"height": size[1], "width": size[0]}
+    if settings["num_inference_steps"] is not None:
+        options["num_inference_steps"] = settings["num_inference_steps"]
+    with torch.inference_mode():
+        return pipe(prompt=list(prompts), **options).images
+
 @st.cache_data(show_spinner=False)
 def generate_story_image_stable_diffusion(prompt, size=(512, 512), model_id="stabilityai/stable-diffusion-2-1"):
     """
@@ -87,9 +179,7 @@ def generate_story_image_stable_diffusion(prompt, size=(512, 512), model_id="sta
     PIL.Image.Image or None: The generated image as a PIL Image object, or None if generation failed.
     """
     try:
-        pipe = load_stable_diffusion_model(model_id)
-        image = pipe(prompt, height=size[1], width=size[0]).images[0]
-        return image
+        return _run_stable_diffusion([prompt], size, model_id)[0]
     except Exception as e:
         st.error(f"Failed to generate image with Stable Diffusion: {str(e)}")
         return None
@@ -107,6 +197,10 @@ def generate_story_image(story_content, size=(512, 512), model="dalle"):
     Returns:
     PIL.Image.Image or None: The generated image as a PIL Image object, or None if generation failed.
     """
+    # Concurrent identical requests share one generation
+    return get_singleflight("image").do(make_flight_key(story_content, size, model), _generate_story_image, story_content, size, model)
+
+def _generate_story_image(story_content, size, model):
     prompt = preprocess_prompt(story_content)
     
     if model == "dalle":
@@ -117,6 +211,81 @@ def generate_story_image(story_content, size=(512, 512), model="dalle"):
         st.error(f"Unknown model: {model}")
         return None
 
+def extract_scenes(story_content, num_scenes=3, sentences_per_scene=2, max_length=1000):
+    """
+    Split a story into evenly spaced scenes and build an image prompt for each one.
+    
+    Args:
+    story_content (str): The full story content.
+    num_scenes (int): The number of scenes to extract.
+    sentences_per_scene (int): How many opening sentences of each scene go into its prompt.
+    max_length (int): The maximum length of each prompt.
+    
+    Returns:
+    list: One prompt per scene, in story order (fewer if the story is very short).
+    """
+    sentences = split_sentences(story_content)
+    num_scenes = min(num_scenes, len(sentences))
+    prompts = []
+    for i in range(num_scenes):
+        start = i * len(sentences) // num_scenes
+        end = (i + 1) * len(sentences) // num_scenes
+        scene = " ".join(sentences[start:min(end, start + sentences_per_scene)])
+        prompt = f"Create an illustration of this scene from a story: {scene}"
+        if len(prompt) > max_length:
+            prompt = prompt[:max_length-3] + "..."
+        prompts.append(prompt)
+    return prompts
+
+@st.cache_data(show_spinner=False)
+def generate_story_scene_images(story_content, num_scenes=3, size=(512, 512), model="dalle", batch_size=None):
+    """
+    Illustrate a story with one image per scene.
+    
+    Stable Diffusion renders the scenes in batched pipeline calls of `batch_size`
+    prompts (all scenes at once by default); DALL-E, which only returns one image
+    per request, is called for all scenes concurrently.
+    
+    Args:
+    story_content (str): The full story content.
+    num_scenes (int): The number of scenes to illustrate.
+    size (tuple): The size of the images to generate.
+    model (str): The model to use for image generation ("dalle" or a Stable Diffusion model ID).
+    batch_size (int): Maximum number of prompts per Stable Diffusion call.
+    
+    Returns:
+    list: The generated PIL images in story order (empty if generation failed).
+    """
+    prompts = extract_scenes(story_content, num_scenes)
+    if not prompts:
+        return []
+    try:
+        return get_singleflight("image").do(
+            make_flight_key("scenes", story_content, num_scenes, size, model, batch_size),
+            _generate_scene_images, prompts, size, model, batch_size,
+        )
+    except Exception as e:
+        st.error(f"Failed to generate scene images: {str(e)}")
+        return []
+
+def _generate_scene_images(prompts, size, model, batch_size):
+    if model == "dalle":
+        dalle_size = f"{size[0]}x{size[1]}"
+        if dalle_size not in ["1024x1024", "1792x1024", "1024x1792"]:
+            dalle_size = "1024x1024"
+        return run_async(_gather_images([_generate_image_dalle_async(prompt, dalle_size) for prompt in prompts]))
+    elif model.startswith("stabilityai/") or model.startswith("runwayml/"):
+        batch_size = batch_size or len(prompts)
+        images = []
+        for i in range(0, len(prompts), batch_size):
+            images.extend(_run_stable_diffusion(prompts[i:i + batch_size], size, model))
+        return images
+    else:
+        raise ValueError(f"Unknown model: {model}")
+
+async def _gather_images(coros):
+    return list(await asyncio.gather(*coros))
+
 def resize_image(image, max_size=(800, 600)):
     """
     Resize an image while maintaining its aspect ratio.
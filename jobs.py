@@ -0,0 +1,119 @@
+import logging
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+
+from config import get_setting
+
+PENDING = "pending"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+DEFAULT_MAX_WORKERS = 4
+# Finished jobs are kept until this many newer jobs have finished after them
+MAX_FINISHED_JOBS = 500
+
+@dataclass
+class Job:
+    """A unit of background work and, once it has finished, its result or error."""
+    id: str
+    kind: str
+    status: str = PENDING
+    result: object = None
+    error: str = None
+    progress: list = field(default_factory=list)
+    created_at: float = field(default_factory=time.time)
+    finished_at: float = None
+
+    @property
+    def finished(self):
+        return self.status in (DONE, FAILED)
+
+class JobQueue:
+    """
+    In-process job queue for slow media generation (images, audio).
+
+    Jobs run on a thread pool; image and audio generation spend their time in
+    network I/O or in torch/native code that releases the GIL, so threads keep
+    the Streamlit script thread free without the cost of pickling results
+    across processes.
+    """
+
+    def __init__(self, max_workers=DEFAULT_MAX_WORKERS):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="storify-job")
+        self._jobs = OrderedDict()
+        self._lock = threading.Lock()
+
+    def submit(self, kind, fn, *args, with_progress=False, **kwargs):
+        """
+        Queue fn(*args, **kwargs) and return the new job's id immediately.
+        With `with_progress`, fn also receives the job's `progress` list as a
+        keyword argument and may append partial results to it while it runs.
+        """
+        job = Job(id=uuid.uuid4().hex, kind=kind)
+        if with_progress:
+            kwargs["progress"] = job.progress
+        with self._lock:
+            self._jobs[job.id] = job
+        self._executor.submit(self._run, job, fn, args, kwargs)
+        return job.id
+
+    def _run(self, job, fn, args, kwargs):
+        job.status = RUNNING
+        try:
+            result = fn(*args, **kwargs)
+            if result is None or result == []:
+                raise RuntimeError(f"{job.kind} generation returned no result")
+            job.result = result
+            job.status = DONE
+        except Exception as e:
+            logging.error(f"Background {job.kind} job {job.id} failed: {str(e)}")
+            job.error = str(e)
+            job.status = FAILED
+        finally:
+            job.finished_at = time.time()
+            self._prune()
+
+    def _prune(self):
+        with self._lock:
+            finished = [job_id for job_id, job in self._jobs.items() if job.finished]
+            for job_id in finished[:max(0, len(finished) - MAX_FINISHED_JOBS)]:
+                del self._jobs[job_id]
+
+    def get(self, job_id):
+        """
+        Return the Job for an id, or None if it is unknown or has been pruned.
+        """
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def status(self, job_id):
+        job = self.get(job_id)
+        return job.status if job else None
+
+    def pop(self, job_id):
+        """
+        Remove a finished job and return it, so its result is only held by the caller.
+        """
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is not None and job.finished:
+                del self._jobs[job_id]
+            return job
+
+_job_queue = None
+_job_queue_lock = threading.Lock()
+
+def get_job_queue():
+    """
+    Return the process-wide JobQueue, sized from the JOB_WORKERS secret.
+    """
+    global _job_queue
+    with _job_queue_lock:
+        if _job_queue is None:
+            _job_queue = JobQueue(int(get_setting("JOB_WORKERS", DEFAULT_MAX_WORKERS)))
+        return _job_queue
@@ -8,7 +8,6 @@ logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(
 st.set_page_config(layout="wide")
 
 import logging
-from database import get_database_connection, close_database_connection
 
 # Set up logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -25,23 +24,19 @@ from auth import (
     store_reset_token,
     verify_reset_token,
     change_password,
-    clear_reset_token
+    clear_reset_token,
+    start_token_sweeper,
+    start_password_hash_tuning
 )
 from email_utils import send_confirmation_email, send_password_reset_email, send_welcome_email
-from story_generation import generate_story, edit_story, generate_story_ideas
-from image_generation import generate_story_image_dalle
-from audio_generation import text_to_speech
-from utils import image_to_base64, base64_to_image
+from story_generation import stream_story, edit_story, generate_story_ideas, STORY_ERROR_MESSAGE
+from ui_components import queue_story_media, render_pending_media, persist_story, hydrate_session
+from repository import flush_story_writes_async
+from clients import submit_async
 import time
 
-# Load environment variables and set up OpenAI API key
-from dotenv import load_dotenv
-import os
-import openai
-
-openai.api_key = st.secrets["OPENAI_API_KEY"]
-
-# ... (rest of the code remains the same)
+# Minimum time between two markdown re-renders while a story is streaming in
+STREAM_RENDER_INTERVAL = 0.05
 
 def initialize_session_state():
     if 'messages' not in st.session_state:
@@ -85,8 +80,11 @@ def handle_story_editing():
     if st.button("Submit Edits"):
         with st.spinner("Incorporating your edits..."):
             revised_story = edit_story(st.session_state.current_story, edited_story, st.session_state.story_genre, st.session_state.story_length)
-            st.session_state.messages.append({"role": "user", "content": "I made some edits to the story."})
-            st.session_state.messages.append({"role": "assistant", "content": revised_story})
+            edit_prompt = "I made some edits to the story."
+            revised_message = {"role": "assistant", "content": revised_story}
+            persist_story(revised_message, edit_prompt, parent_uid=st.session_state.get("current_story_uid"))
+            st.session_state.messages.append({"role": "user", "content": edit_prompt})
+            st.session_state.messages.append(revised_message)
             st.session_state.editing_story = False
             st.session_state.current_story = ""
             st.rerun()
@@ -95,61 +93,55 @@ def handle_story_editing():
         st.session_state.current_story = ""
         st.rerun()
 
+def render_story_stream(message_placeholder, deltas):
+    """
+    Render streamed text deltas into a placeholder, batching re-renders so the
+    markdown is redrawn at most once per STREAM_RENDER_INTERVAL instead of per character.
+    """
+    full_response = ""
+    last_render = 0.0
+    for delta in deltas:
+        full_response += delta
+        now = time.monotonic()
+        if now - last_render >= STREAM_RENDER_INTERVAL:
+            message_placeholder.markdown(full_response + "▌")
+            last_render = now
+    
+    message_placeholder.markdown(full_response)
+    return full_response
+
 def handle_user_input():
     prompt = st.chat_input("What's your story idea or question?")
     if prompt:
+        # Write anything still queued (e.g. media from finished jobs) while the story streams
+        submit_async(flush_story_writes_async())
         st.session_state.messages.append({"role": "user", "content": prompt})
         with st.chat_message("user"):
             st.markdown(prompt)
         
         with st.chat_message("assistant"):
             message_placeholder = st.empty()
-            full_response = ""
-            current_word = ""
-            
-            with st.spinner("Running..."):
-                for char in generate_story(prompt, st.session_state.messages[:-1], st.session_state.story_genre, st.session_state.story_length, st.session_state.text_model_id):
-                    if char.isspace() or char in ".,!?;:":
-                        if current_word:
-                            full_response += current_word + char
-                            current_word = ""
-                        else:
-                            full_response += char
-                    else:
-                        current_word += char
-                    
-                    time.sleep(0.00005)
-                    message_placeholder.markdown(full_response + current_word + "▌")
-            
-            if current_word:
-                full_response += current_word
-            
-            message_placeholder.markdown(full_response)
+            full_response = render_story_stream(
+                message_placeholder,
+                stream_story(prompt, st.session_state.messages[:-1], st.session_state.story_genre, st.session_state.story_length, st.session_state.text_model_id),
+            )
             
             new_message = {"role": "assistant", "content": full_response.strip()}
+            if not new_message["content"].endswith(STORY_ERROR_MESSAGE):
+                persist_story(new_message, prompt)
             
-            if st.session_state.story_type == "Visual":
-                with st.spinner("Running..."):
-                    image = generate_story_image_dalle(full_response[:1000])
-                    if image:
-                        new_message["image"] = image_to_base64(image)
-                        st.image(image, caption="Generated Story Image")
-            elif st.session_state.story_type == "Audio":
-                with st.spinner("Generating audio..."):
-                    audio_bytes = text_to_speech(full_response)
-                    if audio_bytes:
-                        new_message["audio"] = audio_bytes
-                        st.audio(audio_bytes, format='audio/wav')
-                    else:
-                        st.error("Failed to generate audio. Please try again.")
+            # Show the text right away; media is attached when its background job completes
+            if st.session_state.story_type in ("Visual", "Audio"):
+                queue_story_media(new_message, st.session_state.story_type)
             
             st.session_state.messages.append(new_message)
+            if new_message.get("jobs"):
+                render_pending_media(new_message)
 
 def main():
     try:
-        # Ensure database connection is established
-        get_database_connection()
-        
+        start_token_sweeper()
+        start_password_hash_tuning()
         initialize_session_state()
         handle_email_confirmation()
         from ui_components import handle_authentication, sidebar_settings, display_chat
@@ -157,6 +149,7 @@ def main():
         handle_authentication()
         
         if st.session_state.email:
+            hydrate_session()
             sidebar_settings()
             st.title("Storify Chat")
             if st.session_state.editing_story:
@@ -168,8 +161,9 @@ def main():
         st.error(f"An unexpected error occurred: {str(e)}")
         logging.exception("Unexpected error in main function")
     finally:
-        # We're not closing the connection here anymore
-        pass
+        # Everything generated during this run is written in one transaction,
+        # off the script thread so the next rerun isn't held up by the write
+        submit_async(flush_story_writes_async())
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,115 @@
+import hashlib
+import io
+import os
+import threading
+from collections import OrderedDict
+
+from PIL import features
+
+from config import get_setting
+
+# Generated media is stored once, content-addressed, and chat messages only hold
+# its reference, e.g. "3f2a...9c.webp".
+MEDIA_DIR = '.storify_media'
+DEFAULT_MEMORY_BYTES = 128 * 1024 * 1024
+IMAGE_QUALITY = 90
+
+class MediaStore:
+    """
+    Content-addressed media files on disk behind a size-bounded in-memory LRU.
+    """
+
+    def __init__(self, directory=MEDIA_DIR, memory_bytes=DEFAULT_MEMORY_BYTES, image_quality=IMAGE_QUALITY):
+        self.directory = directory
+        self.memory_bytes = memory_bytes
+        self.image_quality = image_quality
+        self.image_format = "webp" if features.check("webp") else "jpeg"
+        self._memory = OrderedDict()
+        self._memory_size = 0
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, ref):
+        return os.path.join(self.directory, ref[:2], ref)
+
+    def _remember(self, ref, data):
+        with self._lock:
+            if ref in self._memory:
+                self._memory.move_to_end(ref)
+                return
+            if len(data) > self.memory_bytes:
+                return
+            self._memory[ref] = data
+            self._memory_size += len(data)
+            while self._memory_size > self.memory_bytes:
+                _, evicted = self._memory.popitem(last=False)
+                self._memory_size -= len(evicted)
+
+    def put_bytes(self, data, extension):
+        """
+        Store already-encoded media and return its reference.
+
+        Args:
+        data (bytes): The encoded media, e.g. MP3 audio.
+        extension (str): The file extension without a dot.
+
+        Returns:
+        str: The content-addressed reference.
+        """
+        ref = f"{hashlib.sha256(data).hexdigest()}.{extension}"
+        path = self._path(ref)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            temporary_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(temporary_path, "wb") as f:
+                f.write(data)
+            os.replace(temporary_path, path)
+        self._remember(ref, data)
+        return ref
+
+    def put_image(self, image):
+        """
+        Compress a PIL image once and store it.
+
+        Returns:
+        str: The content-addressed reference.
+        """
+        buffer = io.BytesIO()
+        if image.mode not in ("RGB", "L") and self.image_format == "jpeg":
+            image = image.convert("RGB")
+        image.save(buffer, format=self.image_format, quality=self.image_quality)
+        return self.put_bytes(buffer.getvalue(), "webp" if self.image_format == "webp" else "jpg")
+
+    def get(self, ref):
+        """
+        Return the stored bytes for a reference, or None if it does not exist.
+        """
+        with self._lock:
+            data = self._memory.get(ref)
+            if data is not None:
+                self._memory.move_to_end(ref)
+                return data
+        try:
+            with open(self._path(os.path.basename(ref)), "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            return None
+        self._remember(ref, data)
+        return data
+
+_media_store = None
+_media_store_lock = threading.Lock()
+
+def get_media_store():
+    """
+    Return the process-wide MediaStore, configured from MEDIA_* secrets on first use.
+    """
+    global _media_store
+    with _media_store_lock:
+        if _media_store is None:
+            _media_store = MediaStore(
+                directory=get_setting("MEDIA_DIR", MEDIA_DIR),
+                memory_bytes=int(get_setting("MEDIA_MEMORY_BYTES", DEFAULT_MEMORY_BYTES)),
+                image_quality=int(get_setting("MEDIA_IMAGE_QUALITY", IMAGE_QUALITY)),
+            )
+        return _media_store
@@ -0,0 +1,301 @@
+import asyncio
+import hashlib
+import json
+import logging
+import threading
+import time
+from collections import deque
+from dataclasses import dataclass, field
+
+from clients import get_async_openai_client, get_http_session, get_provider_config, provider_slot
+from config import get_settings
+
+# A provider is marked unhealthy after this many consecutive failures and is
+# skipped by the router until the cooldown has passed.
+MAX_CONSECUTIVE_FAILURES = 3
+UNHEALTHY_COOLDOWN_SECONDS = 30
+LATENCY_WINDOW = 200
+
+FAKE_MODEL_ID = "storify-fake"
+
+# Serving a model id with another provider's model (e.g. a Groq model id with a
+# SambaNova model) is off unless this setting is true.
+CROSS_PROVIDER_FALLBACK_SETTING = "ALLOW_CROSS_PROVIDER_FALLBACK"
+
+@dataclass
+class ChatRequest:
+    """A provider-independent chat completion request."""
+    model: str
+    messages: list
+    max_tokens: int
+    temperature: float = 0.8
+
+@dataclass
+class ChatResponse:
+    """A provider-independent chat completion response."""
+    provider: str
+    model: str
+    content: str
+    latency: float
+    output_tokens: int
+    served_model: str = None
+
+@dataclass
+class LatencyStats:
+    """Rolling latency and throughput samples for one provider/model pair."""
+    latencies: deque = field(default_factory=lambda: deque(maxlen=LATENCY_WINDOW))
+    tokens_per_second: deque = field(default_factory=lambda: deque(maxlen=LATENCY_WINDOW))
+    requests: int = 0
+    failures: int = 0
+    consecutive_failures: int = 0
+    last_failure: float = 0.0
+
+    def percentile(self, p):
+        if not self.latencies:
+            return None
+        ordered = sorted(self.latencies)
+        index = min(len(ordered) - 1, max(0, round(p / 100 * len(ordered)) - 1))
+        return ordered[index]
+
+    def is_healthy(self):
+        if self.consecutive_failures < MAX_CONSECUTIVE_FAILURES:
+            return True
+        return time.monotonic() - self.last_failure > UNHEALTHY_COOLDOWN_SECONDS
+
+    def snapshot(self):
+        throughput = sorted(self.tokens_per_second)
+        return {
+            "requests": self.requests,
+            "failures": self.failures,
+            "p50_latency": self.percentile(50),
+            "p95_latency": self.percentile(95),
+            "tokens_per_second": throughput[len(throughput) // 2] if throughput else None,
+            "healthy": self.is_healthy(),
+        }
+
+class Provider:
+    """
+    Base class for text generation backends.
+
+    Subclasses set `name`, map public model ids to the provider's own model
+    names in `models`, and implement `stream`, an async generator of text deltas.
+    `fallback_models` maps other providers' model ids to a substitute model and
+    is only used when cross-provider fallback is enabled.
+    """
+    name = None
+
+    def __init__(self, models, fallback_models=None):
+        self.models = dict(models)
+        self.fallback_models = dict(fallback_models or {})
+
+    def supports(self, model, allow_fallback=False):
+        return model in self.models or (allow_fallback and model in self.fallback_models)
+
+    def resolve(self, model):
+        """
+        Return this provider's own model name for a public model id.
+        """
+        return self.models.get(model) or self.fallback_models[model]
+
+    async def stream(self, request):
+        raise NotImplementedError
+        yield
+
+class OpenAICompatibleProvider(Provider):
+    """Provider for OpenAI and OpenAI-compatible APIs such as SambaNova."""
+
+    def __init__(self, name, models, fallback_models=None):
+        super().__init__(models, fallback_models)
+        self.name = name
+
+    async def stream(self, request):
+        async with provider_slot(self.name):
+            stream = await get_async_openai_client(self.name).chat.completions.create(
+                model=self.resolve(request.model),
+                messages=request.messages,
+                max_tokens=request.max_tokens,
+                temperature=request.temperature,
+                stream=True,
+            )
+            async for chunk in stream:
+                if chunk.choices and chunk.choices[0].delta.content:
+                    yield chunk.choices[0].delta.content
+
+class GroqProvider(Provider):
+    """Provider for the Groq chat completions API, streamed as server-sent events."""
+    name = "groq"
+
+    async def stream(self, request):
+        payload = {
+            "model": self.resolve(request.model),
+            "messages": request.messages,
+            "temperature": request.temperature,
+            "max_tokens": request.max_tokens,
+            "stream": True,
+        }
+        url = f"{get_provider_config(self.name)['base_url']}/chat/completions"
+        async with provider_slot(self.name):
+            async with get_http_session(self.name).post(url, json=payload) as response:
+                response.raise_for_status()
+                async for line in response.content:
+                    line = line.decode("utf-8").strip()
+                    if not line.startswith("data:"):
+                        continue
+                    data = line[len("data:"):].strip()
+                    if data == "[DONE]":
+                        break
+                    choices = json.loads(data).get("choices") or []
+                    delta = choices[0].get("delta", {}).get("content") if choices else None
+                    if delta:
+                        yield delta
+
+class FakeProvider(Provider):
+    """
+    Deterministic local backend for tests and benchmarks.
+
+    The same request always produces the same text, streamed word by word
+    after `first_token_latency` seconds at `tokens_per_second`.
+    """
+    name = "fake"
+
+    def __init__(self, models=(FAKE_MODEL_ID,), first_token_latency=0.0, tokens_per_second=None, name="fake"):
+        super().__init__({model: model for model in models})
+        self.name = name
+        self.first_token_latency = first_token_latency
+        self.tokens_per_second = tokens_per_second
+
+    def complete(self, request):
+        digest = hashlib.sha256(json.dumps(request.messages, sort_keys=True).encode()).hexdigest()
+        words = [f"word{int(digest[i % 64], 16)}" for i in range(max(1, request.max_tokens // 2))]
+        return f"Once upon a time ({digest[:8]}) " + " ".join(words) + "."
+
+    async def stream(self, request):
+        if self.first_token_latency:
+            await asyncio.sleep(self.first_token_latency)
+        for i, word in enumerate(self.complete(request).split(" ")):
+            if self.tokens_per_second:
+                await asyncio.sleep(1 / self.tokens_per_second)
+            yield word if i == 0 else " " + word
+
+_providers = {}
+_stats = {}
+_stats_lock = threading.Lock()
+
+def register_provider(provider):
+    """
+    Register a provider with the router, replacing any provider with the same name.
+    """
+    _providers[provider.name] = provider
+
+def get_provider(name):
+    return _providers[name]
+
+def _get_stats(provider_name, model):
+    with _stats_lock:
+        return _stats.setdefault((provider_name, model), LatencyStats())
+
+def _record(provider_name, model, latency=None, tokens=0, failed=False):
+    stats = _get_stats(provider_name, model)
+    with _stats_lock:
+        stats.requests += 1
+        if failed:
+            stats.failures += 1
+            stats.consecutive_failures += 1
+            stats.last_failure = time.monotonic()
+            return
+        stats.consecutive_failures = 0
+        stats.latencies.append(latency)
+        if latency > 0:
+            stats.tokens_per_second.append(tokens / latency)
+
+def get_latency_stats():
+    """
+    Return p50/p95 latency, tokens/sec and health for every provider/model pair seen so far.
+
+    Returns:
+    dict: Mapping of (provider, model) to a stats snapshot.
+    """
+    with _stats_lock:
+        return {key: stats.snapshot() for key, stats in _stats.items()}
+
+def route(model):
+    """
+    Return the providers that can serve a model, fastest healthy backend first.
+    Providers without samples yet are tried first so every backend gets measured.
+    Providers that would substitute another model come last, and only when
+    ALLOW_CROSS_PROVIDER_FALLBACK is set.
+
+    Args:
+    model (str): The public text model id, e.g. st.session_state.text_model_id.
+
+    Returns:
+    list: Candidate providers in the order they should be tried.
+    """
+    allow_fallback = get_settings().get_bool(CROSS_PROVIDER_FALLBACK_SETTING)
+    candidates = [provider for provider in _providers.values() if provider.supports(model, allow_fallback)]
+    if not candidates:
+        raise ValueError(f"No provider registered for model: {model}")
+
+    def sort_key(provider):
+        stats = _get_stats(provider.name, model)
+        p50 = stats.percentile(50)
+        return (model not in provider.models, not stats.is_healthy(), p50 is not None, p50 or 0.0)
+
+    return sorted(candidates, key=sort_key)
+
+async def stream_chat(request, served_by=None):
+    """
+    Stream a chat completion from the best available provider, recording latency stats.
+    Falls back to the next candidate if a provider fails before sending any text.
+
+    Args:
+    request (ChatRequest): The request to run.
+    served_by (dict): Optional dict that receives the provider used under "provider"
+    and that provider's model name under "model".
+    """
+    last_error = None
+    for provider in route(request.model):
+        start = time.monotonic()
+        tokens = 0
+        try:
+            async for delta in provider.stream(request):
+                tokens += 1
+                yield delta
+        except Exception as e:
+            _record(provider.name, request.model, failed=True)
+            logging.warning(f"Provider {provider.name} failed for model {request.model}: {str(e)}")
+            if tokens:
+                raise
+            last_error = e
+            continue
+        _record(provider.name, request.model, latency=time.monotonic() - start, tokens=tokens)
+        served_model = provider.resolve(request.model)
+        logging.info(f"Model {request.model} served by {provider.name} as {served_model}")
+        if served_by is not None:
+            served_by["provider"] = provider.name
+            served_by["model"] = served_model
+        return
+    raise last_error
+
+async def chat(request):
+    """
+    Run a chat completion to the end and return it as a ChatResponse.
+    """
+    start = time.monotonic()
+    served_by = {}
+    deltas = [delta async for delta in stream_chat(request, served_by)]
+    return ChatResponse(served_by["provider"], request.model, "".join(deltas), time.monotonic() - start, len(deltas), served_by["model"])
+
+register_provider(OpenAICompatibleProvider("openai", {
+    "gpt-4-1106-preview": "gpt-4-1106-preview",
+    "gpt-3.5-turbo": "gpt-3.5-turbo",
+}))
+register_provider(GroqProvider({
+    "llama-3.1-70b-versatile": "llama-3.1-70b-versatile",
+}))
+register_provider(OpenAICompatibleProvider("sambanova", {
+    "Meta-Llama-3.1-405B-Instruct": "Meta-Llama-3.1-405B-Instruct",
+}, fallback_models={
+    "llama-3.1-70b-versatile": "Meta-Llama-3.1-70B-Instruct",
+}))
+register_provider(FakeProvider())
@@ -0,0 +1,79 @@
+import asyncio
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import auth
+import database
+
+# Async access to the database for code running on the background I/O loop.
+#
+# sqlite3 calls block, so they run on a dedicated executor rather than on the
+# loop itself or the default executor shared with other blocking work. It is
+# sized to the connection pools: more threads would only wait for a connection.
+_db_executor = None
+_db_executor_lock = threading.Lock()
+
+def get_db_executor():
+    global _db_executor
+    with _db_executor_lock:
+        if _db_executor is None:
+            _db_executor = ThreadPoolExecutor(
+                max_workers=database.WRITER_POOL_SIZE + database.READER_POOL_SIZE,
+                thread_name_prefix="storify-db",
+            )
+        return _db_executor
+
+async def run_in_db(fn, *args, **kwargs):
+    """
+    Run a blocking database function on the database executor and await its result.
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(get_db_executor(), functools.partial(fn, *args, **kwargs))
+
+async def verify_user_async(email, password):
+    return await run_in_db(auth.verify_user, email, password)
+
+async def user_exists_async(email):
+    return await run_in_db(auth.user_exists, email)
+
+async def store_confirmation_token_async(email, token):
+    return await run_in_db(auth.store_confirmation_token, email, token)
+
+async def get_user_async(email):
+    return await run_in_db(database.get_user, email)
+
+async def get_user_id_async(email):
+    return await run_in_db(database.get_user_id, email)
+
+async def get_user_stories_async(user_id, limit=None, before=None):
+    return await run_in_db(database.get_user_stories, user_id, limit, before)
+
+async def save_story_async(user_id, title, content, genre, prompt=None, parent_uid=None, media=None):
+    return await run_in_db(database.save_story, user_id, title, content, genre, prompt, parent_uid, media)
+
+async def flush_story_writes_async():
+    await run_in_db(database.flush_story_writes)
+
+async def load_session_async(email, story_limit):
+    """
+    Return (user_id, latest stories) for a user, or (None, []) if the email is unknown.
+    """
+    user_id = await get_user_id_async(email)
+    if user_id is None:
+        return None, []
+    return user_id, await get_user_stories_async(user_id, limit=story_limit)
+
+async def login_async(email, password, story_limit):
+    """
+    Verify a login while the user's latest stories are fetched concurrently,
+    so a successful login can render the chat history without another round trip.
+
+    Returns:
+    tuple: (success, message, (user_id, stories)); the session is (None, []) on failure.
+    """
+    (success, message), session = await asyncio.gather(
+        verify_user_async(email, password),
+        load_session_async(email, story_limit),
+    )
+    return success, message, session if success else (None, [])
@@ -0,0 +1,98 @@
+import hashlib
+import threading
+from concurrent.futures import Future
+
+class SingleFlight:
+    """
+    Deduplicate concurrent identical calls: the first caller for a key (the leader)
+    does the work and every caller that arrives while it runs waits on the same future.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self._lock = threading.Lock()
+        self._in_flight = {}
+        self.calls = 0
+        self.shared = 0
+
+    def acquire(self, key):
+        """
+        Join the in-flight call for a key or become its leader.
+
+        Returns:
+        tuple: (future, is_leader). The leader must call `release` exactly once.
+        """
+        with self._lock:
+            self.calls += 1
+            future = self._in_flight.get(key)
+            if future is not None:
+                self.shared += 1
+                return future, False
+            future = Future()
+            self._in_flight[key] = future
+            return future, True
+
+    def release(self, key, result=None, error=None):
+        """
+        Publish the leader's result (or error) to every waiting caller.
+        """
+        with self._lock:
+            future = self._in_flight.pop(key)
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+
+    def do(self, key, fn, *args, **kwargs):
+        """
+        Call fn(*args, **kwargs) unless an identical call is already running,
+        in which case wait for and return its result.
+        """
+        future, is_leader = self.acquire(key)
+        if not is_leader:
+            return future.result()
+        try:
+            result = fn(*args, **kwargs)
+        except BaseException as e:
+            self.release(key, error=e)
+            raise
+        self.release(key, result=result)
+        return result
+
+    def stats(self):
+        with self._lock:
+            calls, shared = self.calls, self.shared
+        return {
+            "calls": calls,
+            "shared": shared,
+            "dedupe_ratio": shared / calls if calls else 0.0,
+        }
+
+_flights = {}
+_flights_lock = threading.Lock()
+
+def get_singleflight(name):
+    """
+    Return the process-wide SingleFlight group with the given name.
+    """
+    with _flights_lock:
+        if name not in _flights:
+            _flights[name] = SingleFlight(name)
+        return _flights[name]
+
+def get_dedupe_stats():
+    """
+    Return call counts and dedupe ratios for every single-flight group.
+
+    Returns:
+    dict: Mapping of group name to its stats.
+    """
+    with _flights_lock:
+        flights = list(_flights.values())
+    return {flight.name: flight.stats() for flight in flights}
+
+def make_flight_key(*parts):
+    """
+    Build a compact key from request parameters, hashing long text such as stories.
+    """
+    return hashlib.sha256("\x00".join(repr(part) for part in parts).encode()).hexdigest()
@@ -0,0 +1,233 @@
+import hashlib
+import json
+import logging
+import sqlite3
+import threading
+import time
+import unicodedata
+from contextlib import contextmanager
+
+from config import get_setting
+
+# Disk-backed story cache shared by every Streamlit worker on the host.
+CACHE_DB_NAME = 'storify_cache.db'
+DEFAULT_TTL_SECONDS = 24 * 3600
+DEFAULT_MAX_ENTRIES = 5000
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+CACHE_KEY_VERSION = 2
+# Lookups are plain reads. Hit/miss counters and LRU access times are kept in
+# memory and written in one transaction after this many lookups or seconds.
+ACCESS_FLUSH_EVERY = 50
+ACCESS_FLUSH_SECONDS = 5.0
+
+def _normalize_text(text):
+    # Only the encoding of accents and the whitespace are normalized; case can
+    # change what a prompt means, so it is kept
+    return " ".join(unicodedata.normalize("NFC", text).split())
+
+def make_cache_key(prompt, history, genre, length, model):
+    """
+    Build a canonical cache key for a story request.
+
+    The prompt is normalized (Unicode NFC, collapsed whitespace) and the
+    history is reduced to its roles and normalized text, so image/audio payloads and
+    formatting differences don't cause misses.
+
+    Returns:
+    str: A hex SHA-256 digest identifying the request.
+    """
+    history_digest = hashlib.sha256(json.dumps(
+        [[m["role"], _normalize_text(m["content"])] for m in history],
+        ensure_ascii=False,
+        separators=(",", ":"),
+    ).encode()).hexdigest()
+    canonical = json.dumps({
+        "v": CACHE_KEY_VERSION,
+        "prompt": _normalize_text(prompt),
+        "genre": genre,
+        "length": length,
+        "model": model,
+        "history": history_digest,
+    }, ensure_ascii=False, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(canonical.encode()).hexdigest()
+
+class StoryCache:
+    """
+    SQLite-backed LRU/TTL cache of generated stories with hit-rate counters.
+    The database runs in WAL mode so several processes can share it.
+    """
+
+    def __init__(self, path=CACHE_DB_NAME, ttl=DEFAULT_TTL_SECONDS, max_entries=DEFAULT_MAX_ENTRIES, max_bytes=DEFAULT_MAX_BYTES):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._local = threading.local()
+        self._access_lock = threading.Lock()
+        self._pending_hits = 0
+        self._pending_misses = 0
+        self._pending_access = {}
+        self._last_flush = time.monotonic()
+        self._last_stats = {"hits": 0, "misses": 0, "hit_rate": 0.0, "entries": 0, "bytes": 0}
+        self._conn().executescript('''
+        CREATE TABLE IF NOT EXISTS story_cache (
+            key TEXT PRIMARY KEY,
+            value TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            created_at REAL NOT NULL,
+            accessed_at REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_story_cache_accessed_at ON story_cache (accessed_at);
+        CREATE TABLE IF NOT EXISTS story_cache_stats (
+            name TEXT PRIMARY KEY,
+            value INTEGER NOT NULL
+        );
+        INSERT OR IGNORE INTO story_cache_stats (name, value) VALUES ('hits', 0), ('misses', 0);
+        ''')
+
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    @contextmanager
+    def _transaction(self):
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def get(self, key):
+        """
+        Return the cached story for a key, or None on a miss or expired entry.
+        Expired entries are left for `put` to evict.
+        """
+        now = time.time()
+        try:
+            row = self._conn().execute("SELECT value, created_at FROM story_cache WHERE key = ?", (key,)).fetchone()
+        except sqlite3.Error as e:
+            logging.warning(f"Story cache lookup failed: {str(e)}")
+            return None
+        hit = row is not None and now - row[1] <= self.ttl
+        self._record_access(key if hit else None, now)
+        return row[0] if hit else None
+
+    def _record_access(self, key, now):
+        with self._access_lock:
+            if key is None:
+                self._pending_misses += 1
+            else:
+                self._pending_hits += 1
+                self._pending_access[key] = now
+            due = (self._pending_hits + self._pending_misses >= ACCESS_FLUSH_EVERY
+                   or time.monotonic() - self._last_flush >= ACCESS_FLUSH_SECONDS)
+        if due:
+            try:
+                with self._transaction() as conn:
+                    self._flush_access(conn)
+            except sqlite3.Error as e:
+                logging.warning(f"Story cache stats update failed: {str(e)}")
+
+    def _flush_access(self, conn):
+        # Called inside a write transaction; counts are dropped if it fails
+        with self._access_lock:
+            hits, misses, accessed = self._pending_hits, self._pending_misses, self._pending_access
+            self._pending_hits, self._pending_misses, self._pending_access = 0, 0, {}
+            self._last_flush = time.monotonic()
+        if accessed:
+            conn.executemany("UPDATE story_cache SET accessed_at = MAX(accessed_at, ?) WHERE key = ?",
+                             [(accessed_at, key) for key, accessed_at in accessed.items()])
+        conn.execute("UPDATE story_cache_stats SET value = value + ? WHERE name = 'hits'", (hits,))
+        conn.execute("UPDATE story_cache_stats SET value = value + ? WHERE name = 'misses'", (misses,))
+
+    def put(self, key, value):
+        """
+        Store a story and evict expired and least recently used entries past the size caps.
+        """
+        now = time.time()
+        size = len(value.encode("utf-8"))
+        try:
+            with self._transaction() as conn:
+                conn.execute(
+                    "INSERT OR REPLACE INTO story_cache (key, value, size, created_at, accessed_at) VALUES (?, ?, ?, ?, ?)",
+                    (key, value, size, now, now),
+                )
+                # Apply recent access times before choosing what to evict
+                self._flush_access(conn)
+                self._evict(conn, now)
+        except sqlite3.Error as e:
+            logging.warning(f"Story cache write failed: {str(e)}")
+
+    def _evict(self, conn, now):
+        conn.execute("DELETE FROM story_cache WHERE created_at < ?", (now - self.ttl,))
+        entries, total_bytes = conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM story_cache").fetchone()
+        if entries <= self.max_entries and total_bytes <= self.max_bytes:
+            return
+        evicted = []
+        for key, size in conn.execute("SELECT key, size FROM story_cache ORDER BY accessed_at"):
+            if entries <= self.max_entries and total_bytes <= self.max_bytes:
+                break
+            evicted.append((key,))
+            entries -= 1
+            total_bytes -= size
+        conn.executemany("DELETE FROM story_cache WHERE key = ?", evicted)
+
+    def stats(self):
+        """
+        Return cache counters shared across all processes. Buffered counters
+        are written first if there are any; the counts themselves are plain
+        reads. If the database is locked the last known stats are returned.
+
+        Returns:
+        dict: hits, misses, hit_rate, entries and bytes.
+        """
+        with self._access_lock:
+            pending = self._pending_hits or self._pending_misses or self._pending_access
+        if pending:
+            try:
+                with self._transaction() as conn:
+                    self._flush_access(conn)
+            except sqlite3.Error as e:
+                logging.warning(f"Story cache stats update failed: {str(e)}")
+        try:
+            conn = self._conn()
+            counters = dict(conn.execute("SELECT name, value FROM story_cache_stats").fetchall())
+            entries, total_bytes = conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM story_cache").fetchone()
+        except sqlite3.Error as e:
+            logging.warning(f"Story cache stats unavailable: {str(e)}")
+            return dict(self._last_stats)
+        lookups = counters.get("hits", 0) + counters.get("misses", 0)
+        self._last_stats = {
+            "hits": counters.get("hits", 0),
+            "misses": counters.get("misses", 0),
+            "hit_rate": counters.get("hits", 0) / lookups if lookups else 0.0,
+            "entries": entries,
+            "bytes": total_bytes,
+        }
+        return dict(self._last_stats)
+
+_story_cache = None
+_story_cache_lock = threading.Lock()
+
+def get_story_cache():
+    """
+    Return the process-wide StoryCache, configured from secrets on first use.
+    """
+    global _story_cache
+    with _story_cache_lock:
+        if _story_cache is None:
+            _story_cache = StoryCache(
+                path=get_setting("STORY_CACHE_PATH", CACHE_DB_NAME),
+                ttl=float(get_setting("STORY_CACHE_TTL_SECONDS", DEFAULT_TTL_SECONDS)),
+                max_entries=int(get_setting("STORY_CACHE_MAX_ENTRIES", DEFAULT_MAX_ENTRIES)),
+                max_bytes=int(get_setting("STORY_CACHE_MAX_BYTES", DEFAULT_MAX_BYTES)),
+            )
+        return _story_cache
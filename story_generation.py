@@ -1,103 +1,114 @@
-import openai
 import random
-import asyncio
-import aiohttp
-import hashlib
 import streamlit as st
-from openai import OpenAI
+from clients import iterate_async, run_async
+from history import compact_history
+from providers import ChatRequest, chat, stream_chat
+from singleflight import get_singleflight
+from story_cache import get_story_cache, make_cache_key
 
-# Set your OpenAI API key
-client = OpenAI(api_key=st.secrets["OPENAI_API_KEY"])
+LENGTH_TOKENS = {"Short": 200, "Medium": 500, "Long": 800}
 
-# Set your Groq API key
-GROQ_API_KEY = st.secrets["GROQ_API_KEY"]
+STORY_ERROR_MESSAGE = "I apologize, but I encountered an error while trying to generate the story. Please try again later."
 
-# Add Sambanova API key
-SAMBANOVA_API_KEY = st.secrets["SAMBANOVA_API_KEY"]
-
-@st.cache_data(ttl=3600, max_entries=100, show_spinner=False)
 def generate_story(prompt, history, genre, length, model):
     """
     Generate a story based on the given prompt, history, genre, length, and model.
-    This function uses caching to improve performance and reduce API calls.
+    Results are kept in the shared on-disk story cache to reduce API calls.
     """
-    input_key = hashlib.md5(f"{prompt}|{history}|{genre}|{length}|{model}".encode()).hexdigest()
-    
-    @st.cache_data(ttl=3600, show_spinner=False)
-    def _generate_story(input_key):
-        return asyncio.run(generate_story_async(prompt, history, genre, length, model))
+    cache = get_story_cache()
+    cache_key = make_cache_key(prompt, history, genre, length, model)
+    story = cache.get(cache_key)
+    if story is not None:
+        return story
 
-    return _generate_story(input_key)
+    try:
+        return get_singleflight("story").do(cache_key, _generate_and_cache, cache, cache_key, prompt, history, genre, length, model)
+    except Exception as e:
+        st.error(f"An error occurred while generating the story: {str(e)}")
+        return STORY_ERROR_MESSAGE
 
-async def generate_story_async(prompt, history, genre, length, model):
+def _generate_and_cache(cache, cache_key, prompt, history, genre, length, model):
+    story = run_async(generate_story_async(prompt, history, genre, length, model))
+    cache.put(cache_key, story)
+    return story
+
+def build_messages(prompt, history, genre, length):
     """
-    Asynchronous function to generate a story using either the OpenAI API, Groq API, or SambaNova API.
+    Assemble the chat messages sent to the model for a story request.
     """
-    length_tokens = {"Short": 200, "Medium": 500, "Long": 800}
-    
     system_message = f"""You are an innovative educator with a unique ability: you can teach any subject, including languages like Japanese or Urdu, through engaging {genre.lower()} stories. Your role is to act as a teacher/instructor, using storytelling as your primary method of education.
 
     // ... rest of the system message ...
 
-    Please aim for a story length of approximately {length_tokens[length]} words, balancing narrative and educational content appropriately."""
+    Please aim for a story length of approximately {LENGTH_TOKENS[length]} words, balancing narrative and educational content appropriately."""
 
-    messages = [
+    return [
         {"role": "system", "content": system_message},
         *[{"role": m["role"], "content": m["content"]} for m in history],
         {"role": "user", "content": prompt}
     ]
-    
+
+async def generate_story_async(prompt, history, genre, length, model):
+    """
+    Asynchronous function to generate a story using either the OpenAI API, Groq API, or SambaNova API.
+    """
+    return "".join([delta async for delta in generate_story_stream(prompt, history, genre, length, model)])
+
+async def generate_story_stream(prompt, history, genre, length, model):
+    """
+    Stream a story as it is generated, yielding text deltas as soon as the provider sends them.
+    The provider is picked by the router in providers.py based on the model id, and the
+    history is compacted to the model's token budget before the prompt is assembled.
+    """
+    request = ChatRequest(
+        model=model,
+        messages=build_messages(prompt, compact_history(history, model), genre, length),
+        max_tokens=LENGTH_TOKENS[length] * 2,
+    )
+    async for delta in stream_chat(request):
+        yield delta
+
+def stream_story(prompt, history, genre, length, model):
+    """
+    Synchronous wrapper around generate_story_stream for the Streamlit script thread.
+    Yields text deltas as they arrive instead of waiting for the full completion.
+    """
+    cache = get_story_cache()
+    cache_key = make_cache_key(prompt, history, genre, length, model)
+    story = cache.get(cache_key)
+    if story is not None:
+        yield story
+        return
+
+    # Identical requests already in flight wait for that generation instead of starting another
+    flight = get_singleflight("story")
+    future, is_leader = flight.acquire(cache_key)
+    if not is_leader:
+        try:
+            yield future.result()
+        except Exception as e:
+            st.error(f"An error occurred while generating the story: {str(e)}")
+            yield STORY_ERROR_MESSAGE
+        return
+
+    deltas = []
     try:
-        async with aiohttp.ClientSession() as session:
-            if model == "llama-3.1-70b-versatile":
-                # Use Groq API
-                headers = {
-                    "Authorization": f"Bearer {GROQ_API_KEY}",
-                    "Content-Type": "application/json"
-                }
-                payload = {
-                    "model": model,
-                    "messages": messages,
-                    "temperature": 0.8,
-                    "max_tokens": length_tokens[length] * 2,
-                }
-                async with session.post("https://api.groq.com/v1/chat/completions", json=payload, headers=headers) as response:
-                    result = await response.json()
-            elif model == "Meta-Llama-3.1-405B-Instruct":
-                # Use SambaNova API
-                sambanova_client = OpenAI(
-                    api_key=SAMBANOVA_API_KEY,
-                    base_url="https://api.sambanova.ai/v1",
-                )
-                
-                response = sambanova_client.chat.completions.create(
-                    model=model,
-                    messages=messages,
-                    temperature=0.8,
-                    max_tokens=length_tokens[length] * 2,
-                )
-                
-                result = response.choices[0].message.content
-            else:
-                # Use OpenAI API
-                response = client.chat.completions.create(
-                    model=model,
-                    messages=messages,
-                    max_tokens=length_tokens[length] * 2,
-                    n=1,
-                    temperature=0.8,
-                )
-                result = response.choices[0].message.content
-            
-            if isinstance(result, str):
-                return result
-            elif 'choices' in result and len(result['choices']) > 0:
-                return result['choices'][0]['message']['content']
-            else:
-                raise Exception(f"Unexpected API response format: {result}")
+        for delta in iterate_async(generate_story_stream(prompt, history, genre, length, model)):
+            deltas.append(delta)
+            yield delta
     except Exception as e:
+        flight.release(cache_key, error=e)
         st.error(f"An error occurred while generating the story: {str(e)}")
-        return "I apologize, but I encountered an error while trying to generate the story. Please try again later."
+        yield STORY_ERROR_MESSAGE
+        return
+    except GeneratorExit:
+        flight.release(cache_key, error=RuntimeError("Story generation was interrupted"))
+        raise
+
+    story = "".join(deltas)
+    cache.put(cache_key, story)
+    flight.release(cache_key, result=story)
+
 @st.cache_data(ttl=3600, show_spinner=False)
 def edit_story(original_story, user_edits, genre, length):
     """
@@ -114,14 +125,12 @@ def edit_story(original_story, user_edits, genre, length):
         {"role": "user", "content": f"Original story: {original_story}\n\nUser edits: {user_edits}"}
     ]
     
-    response = openai.ChatCompletion.create(
+    request = ChatRequest(
         model="gpt-3.5-turbo",
         messages=messages,
         max_tokens=length_tokens[length] * 2,
-        n=1,
-        temperature=0.8,
     )
-    return response['choices'][0]['message']['content']
+    return run_async(chat(request)).content
 
 @st.cache_data(show_spinner=False)
 def generate_story_ideas():
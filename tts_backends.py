@@ -0,0 +1,203 @@
+import hashlib
+import io
+import logging
+import shutil
+import subprocess
+import threading
+import wave
+from collections import OrderedDict
+
+from gtts import gTTS
+
+from config import get_setting
+
+DEFAULT_CACHE_BYTES = 64 * 1024 * 1024
+# Language codes are gTTS-style (see audio_generation.detect_language); these
+# differ from espeak's voice names. Unknown voices fall back to ESPEAK_DEFAULT_VOICE.
+ESPEAK_VOICES = {"zh-CN": "cmn", "zh-TW": "cmn", "zh": "cmn"}
+ESPEAK_DEFAULT_VOICE = "en"
+
+# gTTS returns constant-bitrate MP3, so its length in seconds follows from its size
+GTTS_BITRATE = 32000
+
+class TTSBackend:
+    """
+    Base class for text-to-speech engines.
+
+    Subclasses implement `synthesize`. `max_chars` is the longest text the engine
+    should be sent in one call, `join` concatenates chunks in `format` and
+    `duration` returns the playing time of audio in that format.
+    """
+    name = None
+    format = "mp3"
+    max_chars = 5000
+
+    @property
+    def mime_type(self):
+        return f"audio/{self.format}"
+
+    def synthesize(self, text, lang='en', slow=False):
+        raise NotImplementedError
+
+    def join(self, chunks):
+        # MP3 is a plain sequence of frames, so chunks concatenate byte-wise
+        return b"".join(chunks)
+
+    def duration(self, audio_bytes):
+        return len(audio_bytes) * 8 / GTTS_BITRATE
+
+class GTTSBackend(TTSBackend):
+    """Google Text-to-Speech; needs network access and is rate-limited."""
+    name = "gtts"
+
+    def synthesize(self, text, lang='en', slow=False):
+        tts = gTTS(text=text, lang=lang, slow=slow)
+
+        # Use an in-memory bytes buffer instead of a temporary file
+        audio_buffer = io.BytesIO()
+        tts.write_to_fp(audio_buffer)
+        return audio_buffer.getvalue()
+
+class WavBackend(TTSBackend):
+    """Base class for engines that produce WAV audio."""
+    format = "wav"
+
+    def join(self, chunks):
+        output = io.BytesIO()
+        writer = None
+        for chunk in chunks:
+            with wave.open(io.BytesIO(chunk), "rb") as reader:
+                if writer is None:
+                    writer = wave.open(output, "wb")
+                    writer.setparams(reader.getparams())
+                writer.writeframes(reader.readframes(reader.getnframes()))
+        if writer is not None:
+            writer.close()
+        return output.getvalue()
+
+    def duration(self, audio_bytes):
+        with wave.open(io.BytesIO(audio_bytes), "rb") as reader:
+            return reader.getnframes() / reader.getframerate()
+
+class EspeakBackend(WavBackend):
+    """Offline synthesis with the espeak-ng (or espeak) command-line engine."""
+    name = "espeak"
+    max_chars = 2000
+
+    def __init__(self, executable=None):
+        self.executable = executable or shutil.which("espeak-ng") or shutil.which("espeak")
+        if self.executable is None:
+            raise RuntimeError("espeak-ng is not installed")
+        self._voices = self._list_voices()
+
+    def _list_voices(self):
+        # Rows look like " 5  en-us  --/M  English_(America)  gmw/en-US"
+        result = subprocess.run([self.executable, "--voices"], capture_output=True, text=True, check=True)
+        return {line.split()[1] for line in result.stdout.splitlines()[1:] if len(line.split()) > 1}
+
+    def voice(self, lang):
+        """
+        Return the espeak voice for a gTTS-style language code, or the default
+        voice if espeak has nothing for that language.
+        """
+        voice = ESPEAK_VOICES.get(lang, lang.lower())
+        for candidate in (voice, voice.split("-")[0]):
+            if candidate in self._voices:
+                return candidate
+        logging.warning(f"No espeak voice for language {lang!r}; using {ESPEAK_DEFAULT_VOICE!r}")
+        return ESPEAK_DEFAULT_VOICE
+
+    def synthesize(self, text, lang='en', slow=False):
+        words_per_minute = "120" if slow else "170"
+        result = subprocess.run(
+            [self.executable, "--stdout", "-v", self.voice(lang), "-s", words_per_minute],
+            input=text.encode("utf-8"),
+            capture_output=True,
+            check=True,
+        )
+        return result.stdout
+
+class SilenceBackend(WavBackend):
+    """
+    Deterministic offline backend for tests and benchmarks: silence whose
+    length is proportional to the text.
+    """
+    name = "silence"
+    sample_rate = 8000
+
+    def synthesize(self, text, lang='en', slow=False):
+        seconds_per_char = 0.08 if slow else 0.05
+        output = io.BytesIO()
+        with wave.open(output, "wb") as writer:
+            writer.setnchannels(1)
+            writer.setsampwidth(1)
+            writer.setframerate(self.sample_rate)
+            writer.writeframes(b"\x80" * int(len(text) * seconds_per_char * self.sample_rate))
+        return output.getvalue()
+
+class CachedTTSBackend(TTSBackend):
+    """
+    Wrap a backend with an in-memory LRU cache keyed by (text hash, lang, slow),
+    bounded by the total size of the cached audio.
+    """
+
+    def __init__(self, backend, max_bytes=DEFAULT_CACHE_BYTES):
+        self.backend = backend
+        self.name = backend.name
+        self.format = backend.format
+        self.max_chars = backend.max_chars
+        self.max_bytes = max_bytes
+        self._cache = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def synthesize(self, text, lang='en', slow=False):
+        key = (hashlib.sha256(text.encode("utf-8")).hexdigest(), lang, slow)
+        with self._lock:
+            audio_bytes = self._cache.get(key)
+            if audio_bytes is not None:
+                self._cache.move_to_end(key)
+                self.hits += 1
+                return audio_bytes
+            self.misses += 1
+
+        audio_bytes = self.backend.synthesize(text, lang, slow)
+        with self._lock:
+            if key not in self._cache and len(audio_bytes) <= self.max_bytes:
+                self._cache[key] = audio_bytes
+                self._size += len(audio_bytes)
+                while self._size > self.max_bytes:
+                    _, evicted = self._cache.popitem(last=False)
+                    self._size -= len(evicted)
+        return audio_bytes
+
+    def join(self, chunks):
+        return self.backend.join(chunks)
+
+    def duration(self, audio_bytes):
+        return self.backend.duration(audio_bytes)
+
+TTS_BACKENDS = {
+    "gtts": GTTSBackend,
+    "espeak": EspeakBackend,
+    "silence": SilenceBackend,
+}
+
+_tts_backend = None
+_tts_backend_lock = threading.Lock()
+
+def get_tts_backend():
+    """
+    Return the process-wide cached TTS backend selected by the TTS_ENGINE secret
+    ("gtts" by default, "espeak" for offline synthesis, "silence" for tests).
+    """
+    global _tts_backend
+    with _tts_backend_lock:
+        if _tts_backend is None:
+            engine = get_setting("TTS_ENGINE", "gtts")
+            backend = TTS_BACKENDS[engine]()
+            _tts_backend = CachedTTSBackend(backend, int(get_setting("TTS_CACHE_BYTES", DEFAULT_CACHE_BYTES)))
+            logging.info(f"Using TTS engine: {engine}")
+        return _tts_backend
@@ -12,14 +12,42 @@ from auth import (
     store_reset_token,
     verify_reset_token,
     change_password,
-    clear_reset_token
+    clear_reset_token,
+    complete_signup,
+    reset_password
 )
 from email_utils import send_confirmation_email, send_password_reset_email, send_welcome_email
 from story_generation import generate_story_ideas
-from image_generation import generate_story_image_dalle
-from audio_generation import text_to_speech
-from utils import image_to_base64, base64_to_image
-from image_generation import generate_story_image
+from providers import get_latency_stats
+from singleflight import get_dedupe_stats
+from story_cache import get_story_cache
+from audio_generation import synthesize_story_audio
+from tts_backends import get_tts_backend
+from image_generation import generate_story_image, generate_story_scene_images
+from jobs import DONE, get_job_queue
+from media_store import get_media_store
+from database import get_user_stories, queue_story, queue_story_media_update, flush_story_writes
+from repository import flush_story_writes_async, load_session_async, login_async
+from clients import run_async, submit_async
+from utils import truncate_text
+import json
+import time
+import sqlite3
+
+# Seconds between checks for finished background media jobs
+JOB_POLL_INTERVAL = 1.0
+
+# Number of most recent messages rendered on each rerun
+CHAT_WINDOW = 20
+
+# Stories loaded from the database per page of history; each story is a prompt and a reply
+STORY_PAGE_SIZE = CHAT_WINDOW // 2
+
+# Message keys that are persisted in the stories.media column
+MEDIA_KEYS = ("image_ref", "image_refs", "audio_ref", "audio_format", "audio_timings")
+
+# Seconds the story cache stats shown in the Performance panel are reused
+PERFORMANCE_STATS_TTL = 10
 
 def handle_authentication():
     if st.session_state.email is None:
@@ -38,9 +66,10 @@ def handle_authentication():
                         resend_button = st.form_submit_button("Resend Confirmation Email", use_container_width=True)
                 
                 if login_button:
-                    success, message = verify_user(email, password)
+                    success, message, session = run_async(login_async(email, password, STORY_PAGE_SIZE))
                     if success:
                         st.session_state.email = email
+                        st.session_state.prefetched_session = session
                         st.success(message)
                         st.rerun()
                     else:
@@ -71,14 +100,11 @@ def handle_authentication():
                     confirm_password = st.text_input("Confirm New Password", type="password")
                     if st.button("Confirm Email and Set Password"):
                         if new_password == confirm_password:
-                            if confirm_email(st.session_state.unconfirmed_email, confirmation_token):
-                                if add_user(st.session_state.unconfirmed_email, new_password):
-                                    st.success("Email confirmed and password set successfully! You can now log in.")
-                                    st.session_state.show_confirmation_fields = False
-                                    st.session_state.show_resend_button = False
-                                    st.rerun()
-                                else:
-                                    st.error("An error occurred while setting your password. Please try again.")
+                            if complete_signup(st.session_state.unconfirmed_email, confirmation_token, new_password):
+                                st.success("Email confirmed and password set successfully! You can now log in.")
+                                st.session_state.show_confirmation_fields = False
+                                st.session_state.show_resend_button = False
+                                st.rerun()
                             else:
                                 st.error("Invalid confirmation token. Please check and try again.")
                         else:
@@ -97,15 +123,11 @@ def handle_authentication():
                             token_stored = store_confirmation_token(new_email, confirmation_token)
                             if token_stored:
                                 logging.info(f"Confirmation token stored successfully for email: {new_email}")
-                                try:
-                                    send_confirmation_email(new_email, confirmation_token)
-                                    logging.info(f"Confirmation email sent successfully to: {new_email}")
-                                    st.success("Verification token sent to your email. Please check and enter it below.")
-                                    st.session_state.signup_email = new_email
-                                    st.session_state.show_confirmation_fields = True
-                                except Exception as e:
-                                    logging.error(f"Error sending confirmation email: {str(e)}")
-                                    st.error(f"Failed to send confirmation email. Please try again. Error: {str(e)}")
+                                send_confirmation_email(new_email, confirmation_token)
+                                logging.info(f"Confirmation email queued for: {new_email}")
+                                st.success("Verification token sent to your email. Please check and enter it below.")
+                                st.session_state.signup_email = new_email
+                                st.session_state.show_confirmation_fields = True
                             else:
                                 st.error("Failed to store confirmation token. Please try again.")
                         except Exception as e:
@@ -133,12 +155,9 @@ def handle_authentication():
 
                     if st.button("Complete Sign Up", use_container_width=True):
                         if password == confirm_password:
-                            if verify_confirmation_token(new_email, confirmation_token):
-                                if add_user(new_email, password):
-                                    st.success("Account created successfully! You can now log in.")
-                                    st.session_state.show_confirmation_fields = False
-                                else:
-                                    st.error("An error occurred while creating your account. Please try again.")
+                            if complete_signup(new_email, confirmation_token, password):
+                                st.success("Account created successfully! You can now log in.")
+                                st.session_state.show_confirmation_fields = False
                             else:
                                 st.error("Invalid confirmation token. Please check and try again.")
                         else:
@@ -163,21 +182,52 @@ def handle_authentication():
 
                 if st.button("Reset Password"):
                     if new_password == confirm_new_password:
-                        if verify_reset_token(email, reset_token):
-                            if change_password(email, new_password):
-                                clear_reset_token(email)
-                                st.success("Password reset successfully. You can now log in with your new password.")
-                            else:
-                                st.error("An error occurred while resetting your password. Please try again.")
+                        if reset_password(email, reset_token, new_password):
+                            st.success("Password reset successfully. You can now log in with your new password.")
                         else:
-                            st.error("Passwords do not match. Please try again.")
+                            st.error("Invalid or expired reset token. Please request a new one.")
+                    else:
+                        st.error("Passwords do not match. Please try again.")
 
     else:
         st.write(f"Welcome, {st.session_state.email}!")
         if st.button("Logout"):
+            flush_story_writes()
             st.session_state.email = None
+            st.session_state.user_id = None
+            st.session_state.messages = []
             st.rerun()
 
+@st.cache_data(ttl=PERFORMANCE_STATS_TTL, show_spinner=False)
+def _story_cache_stats():
+    try:
+        return get_story_cache().stats()
+    except sqlite3.Error as e:
+        logging.warning(f"Could not read story cache stats: {str(e)}")
+        return None
+
+def render_performance_stats():
+    stats = get_latency_stats()
+    if stats:
+        st.table([
+            {
+                "Provider": provider,
+                "Model": model,
+                "p50 (s)": snapshot["p50_latency"],
+                "p95 (s)": snapshot["p95_latency"],
+                "Tokens/s": snapshot["tokens_per_second"],
+                "Healthy": snapshot["healthy"],
+            }
+            for (provider, model), snapshot in stats.items()
+        ])
+    cache_stats = _story_cache_stats()
+    if cache_stats is None:
+        st.caption("Story cache stats are unavailable right now")
+    else:
+        st.caption(f"Story cache hit rate: {cache_stats['hit_rate']:.0%} ({cache_stats['entries']} stories)")
+    for name, flight_stats in get_dedupe_stats().items():
+        st.caption(f"Deduplicated {name} requests: {flight_stats['dedupe_ratio']:.0%} of {flight_stats['calls']}")
+
 def sidebar_settings():
     st.sidebar.title("Storify")
     st.sidebar.subheader("Settings")
@@ -204,6 +254,14 @@ def sidebar_settings():
         }
         st.session_state.image_model = st.sidebar.selectbox("Image Generation Model:", list(image_models.keys()), key="image_model_select")
         st.session_state.image_model_id = image_models[st.session_state.image_model]
+        st.session_state.scene_count = st.sidebar.slider("Scenes per story:", 1, 4, 1, key="scene_count_slider")
+    
+    with st.sidebar.expander("Performance"):
+        # Stats are only gathered on request, not on every rerun of every session
+        if st.toggle("Show stats", key="show_performance_stats"):
+            if st.button("Refresh stats"):
+                _story_cache_stats.clear()
+            render_performance_stats()
     
     if st.sidebar.button("Generate Story Idea"):
         idea = generate_story_ideas()
@@ -211,53 +269,272 @@ def sidebar_settings():
     
     if st.sidebar.button("Clear Chat"):
         st.session_state.messages = []
+        st.session_state.chat_window = CHAT_WINDOW
         st.session_state.editing_story = False
         st.session_state.current_story = ""
         st.rerun()
 
+def _generate_image_ref(story_content, model):
+    image = generate_story_image(story_content, model=model)
+    return get_media_store().put_image(image) if image else None
+
+def _generate_scene_image_refs(story_content, num_scenes, model):
+    media_store = get_media_store()
+    return [media_store.put_image(image) for image in generate_story_scene_images(story_content, num_scenes, model=model)]
+
+def _synthesize_audio_ref(story_text, progress=None):
+    result = synthesize_story_audio(story_text, progress=progress)
+    if result is None:
+        return None
+    extension = result["format"].split("/")[-1]
+    return {"audio_ref": get_media_store().put_bytes(result.pop("audio"), extension), **result}
+
+def queue_story_media(message, story_type):
+    """
+    Queue background generation of a message's image(s) or audio and record the job ids on it.
+    Jobs store the media in the media store and return only its reference.
+    """
+    job_queue = get_job_queue()
+    jobs = message.setdefault("jobs", {})
+    if story_type == "Visual":
+        model = st.session_state.get("image_model_id", "dalle")
+        if st.session_state.get("scene_count", 1) > 1:
+            jobs["images"] = job_queue.submit("images", _generate_scene_image_refs, message["content"], st.session_state.scene_count, model)
+        else:
+            jobs["image"] = job_queue.submit("image", _generate_image_ref, message["content"][:1000], model)
+    elif story_type == "Audio":
+        jobs["audio"] = job_queue.submit("audio", _synthesize_audio_ref, message["content"], with_progress=True)
+
+def attach_media(message, kind, result):
+    if kind == "image":
+        message["image_ref"] = result
+    elif kind == "images":
+        message["image_refs"] = result
+    elif kind == "audio":
+        message["audio_ref"] = result["audio_ref"]
+        message["audio_format"] = result["format"]
+        message["audio_timings"] = {"first_audio": result["first_audio"], "total": result["total"]}
+    if "story_uid" in message:
+        queue_story_media_update(message["story_uid"], {key: message[key] for key in MEDIA_KEYS if key in message})
+
+def persist_story(message, prompt, parent_uid=None):
+    """
+    Queue an assistant message for the next batched write to the stories table
+    and remember its uid so media attached later is saved with it.
+    """
+    user_id = st.session_state.get("user_id")
+    if user_id is None:
+        return
+    message["story_uid"] = queue_story(
+        user_id,
+        truncate_text(prompt, 60),
+        message["content"],
+        st.session_state.story_genre,
+        prompt=prompt,
+        parent_uid=parent_uid,
+        media={key: message[key] for key in MEDIA_KEYS if key in message},
+    )
+
+def _story_to_messages(story):
+    _, uid, title, content, _, prompt, _, media, _ = story
+    assistant_message = {"role": "assistant", "content": content, "story_uid": uid}
+    assistant_message.update(json.loads(media) if media else {})
+    return [{"role": "user", "content": prompt or title}, assistant_message]
+
+def load_story_page():
+    """
+    Prepend the next page of the user's saved stories to the chat history.
+    """
+    _prepend_stories(get_user_stories(st.session_state.user_id, limit=STORY_PAGE_SIZE, before=st.session_state.get("oldest_story")))
+
+def _prepend_stories(stories):
+    messages = []
+    for story in reversed(stories):
+        messages.extend(_story_to_messages(story))
+    st.session_state.messages[:0] = messages
+    if stories:
+        st.session_state.oldest_story = (stories[-1][8], stories[-1][0])
+    st.session_state.stories_exhausted = len(stories) < STORY_PAGE_SIZE
+
+def hydrate_session():
+    """
+    After login, restore the most recent page of the user's stories from the
+    database, using the page prefetched alongside the login check if there is one.
+    """
+    if st.session_state.get("user_id") is not None:
+        return
+    session = st.session_state.pop("prefetched_session", None)
+    user_id, stories = session or run_async(load_session_async(st.session_state.email, STORY_PAGE_SIZE))
+    st.session_state.user_id = user_id
+    st.session_state.messages = []
+    st.session_state.chat_window = CHAT_WINDOW
+    st.session_state.oldest_story = None
+    st.session_state.stories_exhausted = True
+    if user_id is not None:
+        _prepend_stories(stories)
+
+def _advance_audio_playback(message, chunks):
+    """
+    Return the audio to play for a message whose narration is still being
+    synthesized: all chunks ready so far, starting at the position already heard.
+
+    The result is kept on the message (outside MEDIA_KEYS, so it is not saved)
+    and only changes when more audio is ready. Re-rendering an unchanged player
+    lets playback continue instead of restarting it.
+
+    Args:
+    chunks (list): Audio chunks ready so far, or None once the whole audio is ready.
+    """
+    backend = get_tts_backend()
+    playback = message.get("audio_playback")
+    ready = len(chunks) if chunks is not None else None
+    if playback is not None and playback["chunks"] == ready:
+        return playback
+    now = time.monotonic()
+    heard = 0.0
+    if playback is not None:
+        # Playback stops at the end of the audio it was given
+        heard = min(playback["start_time"] + now - playback["started"], playback["duration"])
+    audio = backend.join(chunks) if chunks is not None else get_media_store().get(message["audio_ref"])
+    if audio is None:
+        message.pop("audio_playback", None)
+        return None
+    message["audio_playback"] = {
+        "chunks": ready,
+        "audio": audio,
+        "start_time": round(heard, 1),
+        "started": now,
+        "duration": backend.duration(audio),
+    }
+    return message["audio_playback"]
+
+@st.fragment(run_every=JOB_POLL_INTERVAL)
+def render_pending_media(message):
+    """
+    Poll a message's background jobs without rerunning the whole app, attaching
+    results as they finish and triggering one full rerun to display them.
+    """
+    job_queue = get_job_queue()
+    finished = False
+    for kind, job_id in list(message.get("jobs", {}).items()):
+        job = job_queue.get(job_id)
+        if job is not None and not job.finished:
+            if kind == "audio" and job.progress:
+                # Play every sentence ready so far, resuming where playback has got to
+                playback = _advance_audio_playback(message, list(job.progress))
+                st.audio(playback["audio"], format=get_tts_backend().mime_type, autoplay=True, start_time=playback["start_time"])
+                st.caption(f"Generating audio... {playback['chunks']} sentence(s) ready")
+            else:
+                st.caption(f"Generating {kind}...")
+            continue
+        del message["jobs"][kind]
+        finished = True
+        if job is None:
+            continue
+        job_queue.pop(job_id)
+        if job.status == DONE:
+            attach_media(message, kind, job.result)
+            if kind == "audio" and job.result is not None and "audio_playback" in message:
+                # The full audio continues from where the partial audio got to
+                _advance_audio_playback(message, None)
+        else:
+            st.toast(f"Failed to generate {kind}. Please try again.")
+    if finished:
+        submit_async(flush_story_writes_async())
+        st.rerun()
+
 def display_chat():
-    for i, message in enumerate(st.session_state.messages):
-        with st.chat_message(message["role"]):
-            st.markdown(message["content"])
-            if 'image' in message:
-                st.image(base64_to_image(message['image']), caption="Generated Story Image", use_column_width=True)
-            if 'audio' in message:
-                st.audio(message['audio'], format='audio/mp3')
-            
-            if message['role'] == 'assistant':
-                handle_message_actions(i, message)
+    """
+    Render the most recent CHAT_WINDOW messages (more with "Load earlier messages"),
+    so rerun time doesn't grow with the length of the conversation.
+    """
+    messages = st.session_state.messages
+    window = st.session_state.setdefault("chat_window", CHAT_WINDOW)
+    start = max(0, len(messages) - window)
+    has_saved_stories = not st.session_state.get("stories_exhausted", True)
+    if start > 0 or has_saved_stories:
+        label = f"Load earlier messages ({start} hidden)" if start > 0 else "Load earlier messages"
+        if st.button(label, key="load_earlier_messages"):
+            if start == 0:
+                load_story_page()
+            st.session_state.chat_window += CHAT_WINDOW
+            st.rerun()
+    
+    for i in range(start, len(messages)):
+        display_message(i, messages[i])
 
+def display_message(i, message):
+    with st.chat_message(message["role"]):
+        st.markdown(message["content"])
+        # Media is passed to Streamlit as the stored compressed bytes, without decoding.
+        # A reference can be missing locally, e.g. for a session rehydrated on another host.
+        media_store = get_media_store()
+        if 'image_ref' in message:
+            _show_image(media_store.get(message['image_ref']), "Generated Story Image")
+        for number, image_ref in enumerate(message.get('image_refs', []), start=1):
+            _show_image(media_store.get(image_ref), f"Scene {number}")
+        if 'audio_ref' in message:
+            playback = message.get('audio_playback')
+            if playback is not None and time.monotonic() - playback["started"] > playback["duration"] - playback["start_time"]:
+                # Finished playing; from now on show a plain player
+                message.pop('audio_playback')
+                playback = None
+            audio = playback["audio"] if playback is not None else media_store.get(message['audio_ref'])
+            if audio is None:
+                st.caption("Audio narration is no longer available")
+            elif playback is not None:
+                st.audio(audio, format=message.get('audio_format', 'audio/mp3'), autoplay=True, start_time=playback["start_time"])
+            else:
+                st.audio(audio, format=message.get('audio_format', 'audio/mp3'))
+                if 'audio_timings' in message:
+                    timings = message['audio_timings']
+                    st.caption(f"First audio in {timings['first_audio']:.1f} s · total synthesis {timings['total']:.1f} s")
+        if message.get('jobs'):
+            render_pending_media(message)
+        
+        if message['role'] == 'assistant':
+            handle_message_actions(i, message)
+
+def _show_image(data, caption):
+    if data is None:
+        st.caption(f"{caption} is no longer available")
+        return
+    st.image(data, caption=caption, use_column_width=True)
+
+@st.fragment
 def handle_message_actions(i, message):
+    """
+    Per-message action buttons. As a fragment, clicking one only reruns this
+    message's buttons; actions that change the rest of the page call st.rerun().
+    """
     col1, col2, col3, col4 = st.columns(4)
     with col1:
-        st.button('👍', key=f"action_{i}_1", help="Like this response")
+        if st.button('👍', key=f"action_{i}_1", help="Like this response", type="primary" if message.get('feedback') == 'like' else "secondary"):
+            message['feedback'] = None if message.get('feedback') == 'like' else 'like'
+            st.rerun(scope="fragment")
     with col2:
-        st.button('👎', key=f"action_{i}_2", help="Dislike this response")
+        if st.button('👎', key=f"action_{i}_2", help="Dislike this response", type="primary" if message.get('feedback') == 'dislike' else "secondary"):
+            message['feedback'] = None if message.get('feedback') == 'dislike' else 'dislike'
+            st.rerun(scope="fragment")
     with col3:
         if st.button('Edit', key=f"action_{i}_3", help="Edit this story"):
             st.session_state.editing_story = True
             st.session_state.current_story = message['content']
+            st.session_state.current_story_uid = message.get('story_uid')
             st.rerun()
     with col4:
-        if 'audio' not in message:
+        pending = message.get('jobs', {})
+        if 'audio_ref' not in message and 'audio' not in pending:
             if st.button('Listen', key=f"action_{i}_4", help="Convert to speech"):
-                with st.spinner("Generating audio..."):
-                    audio_bytes = text_to_speech(message['content'])
-                    if audio_bytes:
-                        message['audio'] = audio_bytes
-                        st.audio(audio_bytes, format='audio/wav')
-                    else:
-                        st.error("Failed to generate audio. Please try again.")
+                queue_story_media(message, "Audio")
+                st.rerun()
         
-        if 'image' not in message:
+        if 'image_ref' not in message and 'image' not in pending:
             if st.button('Image', key=f"action_{i}_5", help="Generate image"):
-                with st.spinner("Generating image..."):
-                    image = generate_story_image(message['content'][:1000], model=st.session_state.image_model_id)
-                    if image:
-                        message['image'] = image_to_base64(image)
-                        st.rerun()
-                    else:
-                        st.error("Failed to generate image. Please try again.")
+                message.setdefault("jobs", {})["image"] = get_job_queue().submit(
+                    "image", _generate_image_ref, message['content'][:1000], st.session_state.get("image_model_id", "dalle")
+                )
+                st.rerun()
 
 def handle_story_editing():
     st.subheader("Edit your story")
@@ -129,4 +129,84 @@ def extract_keywords(text, num_keywords=5):
     sorted_words = sorted(word_counts.items(), key=lambda x: x[1], reverse=True)
     return [word for word, count in sorted_words[:num_keywords]]
 
+# Sentence ends: ., !, ? (optionally followed by closing quotes/brackets) and whitespace,
+# or CJK full stops, which are usually not followed by a space
+SENTENCE_BOUNDARY = re.compile(r"(?<=[.!?])\s+|(?<=[.!?][\"'”’)\]])\s+|(?<=[。！？])\s*")
+
+def split_sentences(text):
+    """
+    Split text into sentences in a single pass.
+
+    Args:
+    text (str): The text to split.
+
+    Returns:
+    list: The non-empty sentences, with surrounding whitespace removed.
+    """
+    sentences = []
+    start = 0
+    for match in SENTENCE_BOUNDARY.finditer(text):
+        sentence = text[start:match.start()].strip()
+        if sentence:
+            sentences.append(sentence)
+        start = match.end()
+    sentence = text[start:].strip()
+    if sentence:
+        sentences.append(sentence)
+    return sentences
+
+def _split_long_sentence(sentence, max_length):
+    """Split one over-long sentence at word boundaries, hard-splitting over-long words."""
+    pieces = []
+    current = []
+    current_length = 0
+    for word in sentence.split():
+        while len(word) > max_length:
+            if current:
+                pieces.append(" ".join(current))
+                current, current_length = [], 0
+            pieces.append(word[:max_length])
+            word = word[max_length:]
+        added = len(word) + (1 if current else 0)
+        if current and current_length + added > max_length:
+            pieces.append(" ".join(current))
+            current, current_length, added = [], 0, len(word)
+        if word:
+            current.append(word)
+            current_length += added
+    if current:
+        pieces.append(" ".join(current))
+    return pieces
+
+def chunk_text(text, max_length):
+    """
+    Pack whole sentences into chunks of at most max_length characters.
+
+    Runs in linear time: each sentence is measured once and chunks keep a running
+    length instead of re-joining their contents. Sentences longer than max_length
+    are split at word boundaries.
+
+    Args:
+    text (str): The text to split.
+    max_length (int): The maximum length of each chunk, e.g. a TTS engine's limit.
+
+    Returns:
+    list: A list of text chunks.
+    """
+    chunks = []
+    current = []
+    current_length = 0
+    for sentence in split_sentences(text):
+        pieces = [sentence] if len(sentence) <= max_length else _split_long_sentence(sentence, max_length)
+        for piece in pieces:
+            added = len(piece) + (1 if current else 0)
+            if current and current_length + added > max_length:
+                chunks.append(" ".join(current))
+                current, current_length, added = [], 0, len(piece)
+            current.append(piece)
+            current_length += added
+    if current:
+        chunks.append(" ".join(current))
+    return chunks
+
 # You can add more utility functions here as needed